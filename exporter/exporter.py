@@ -18,10 +18,29 @@ or implied.
 """
 Exports APs data to a CSV file.
 
-The file exports energy consumption per hour and day for 2 weeks, for each AP.
+The file exports energy consumption per hour and day over a time range
+(--start, --end; default: the last 2 weeks), for each AP.
+
+The histories of the APs are read concurrently (--workers), under a rate
+limit of the requests to Thingsboard (--rate), and collected as they
+arrive into columns, aggregated at once per hour and per day. Each
+history is read in chunks (first: --chunk_hours), halved after a failure
+(e.g. server timeout, reply truncated to the limit of values) and doubled
+after a success. Throughput is logged; time ranges that could not be read
+are saved to data/failed-ranges-<time range>.json.
+
+Histories read are cached locally (--cache, default data/history.sqlite;
+see utils/historycache.py): a run reads from Thingsboard only the time
+ranges missing from the cache, e.g. the last hours for a daily export.
+The most recent hours (--refresh_hours) are read again by the next run,
+as Thingsboard may still receive late samples. --invalidate_since (and
+--invalidate_ap) reads the cached history again since a time, e.g. after
+values were corrected in Thingsboard. With --no_cache, the whole
+time range is read. The time range is aligned on the hour.
 
 Assumes:
  - access to Thingsboard through its REST API (file onboard/thingsboard.yml)
+ - optionally, the topology index of the switch collectors (/topology/topology.json)
 """
 
 import os
@@ -32,12 +51,20 @@ import time
 import logging
 import argparse
 import datetime
+import requests
+import functools
+import numpy as np
 import pandas as pd
+import dateutil.tz
 import multiprocessing
-from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from array import array
 
 from utils import tbyaml
+from utils.ratelimit import RateLimiter
 from utils.tbclient import TbRestClient
+from utils.topology import Topology
+from utils.historycache import HistoryCache
 from utils.tbentity import TbEntityType, TbDeviceType
 
 log = logging.getLogger("exporter")
@@ -48,23 +75,213 @@ logging.basicConfig(
 )
 
 
-def read(client, aps):
-    energy = defaultdict(list)
+KEY = "PoE"
+INTERVAL_MS = 3600000  # Aggregation interval of the history: hourly averages
+LIMIT = 10000  # Maximum number of values per key and request
+REQUEST_FILTERS = "&interval={}&limit={}&agg=AVG&keys={}".format(
+    INTERVAL_MS, LIMIT, KEY
+)
+WORKERS = 8  # APs fetched concurrently
+RATE = 10  # Requests per second to Thingsboard
+CHUNK_MS = 7 * 24 * INTERVAL_MS  # First time range of the requests of an AP
+MAX_CHUNK_MS = LIMIT * INTERVAL_MS  # Largest time range read in one request
+MAX_FAILURES = 3  # Consecutive failures of one interval before giving up an AP
+WEEKS = 2  # Default time range, ending at the last full hour
+SERIES = "{}/AVG/{}".format(KEY, INTERVAL_MS)  # Series of the history cache
+CACHE_FILE = "data/history.sqlite"
+REFRESH_MS = 2 * INTERVAL_MS  # Recent history, read again by the next run
+INVALIDATE_SINCE = None  # Cached history read again since this timestamp (ms)
+INVALIDATE_AP = None  # AP whose cached history is read again, None for all
+
+start_ts = None
+end_ts = None
+limiter = None  # Rate limit of the requests, shared by the fetch threads
+cache = None  # Local history cache, shared by the fetch threads; None if disabled
+
+
+def parse_ts(value):
+    """Returns: timestamp (ms) of epoch ms or of an ISO date, e.g. 2023-04-05T14:00."""
+
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+
+
+class PermanentError(Exception):
+    """A failed request that smaller time ranges cannot fix, e.g. unknown AP."""
+
+
+def read_range(client, ap, start_ts, end_ts):
+    """
+    Reads the hourly averages of an AP over a time range.
+
+    Returns: [{"ts": ts, "value": value}], raises if the request failed
+    or if the reply may be truncated by the limit; PermanentError if the AP
+    is not defined or the request is refused (4xx).
+    """
+
+    limiter.wait()
+    try:
+        values = client.tb_read_historical_values(
+            ap, str(start_ts), str(end_ts), REQUEST_FILTERS, raise_errors=True
+        )
+    except LookupError as e:
+        raise PermanentError(e) from e
+    except requests.HTTPError as e:
+        status = e.response.status_code
+        if 400 <= status < 500 and status not in (408, 429):
+            raise PermanentError("HTTP {}".format(status)) from e
+        raise
+    data = values.get(KEY, [])
+    if len(data) >= LIMIT:
+        raise RuntimeError("reply truncated to {} values".format(LIMIT))
+    return data
+
+
+def fetch_range(client, ap, start_ts, end_ts):
+    """
+    Reads the history of an AP over a time range in chunks of adaptive
+    size: a chunk that fails is split in half and read again, down to one
+    interval; the chunk size doubles again after each success. The rest of
+    the range fails at once on a PermanentError, or after MAX_FAILURES
+    consecutive failures of one interval. Chunks read are cached, if the
+    cache is enabled.
+
+    Returns: (data, number of requests, [(start, end)] of the failed ranges).
+    """
+
+    data, failed, n_requests, failures = [], [], 0, 0
+    chunk = min(CHUNK_MS, MAX_CHUNK_MS)
+    current_start_ts = start_ts
+    while current_start_ts < end_ts:
+        current_end_ts = min(current_start_ts + chunk, end_ts)
+        n_requests += 1
+        try:
+            chunk_data = read_range(client, ap, current_start_ts, current_end_ts)
+        except PermanentError as e:
+            log.warning(
+                "{}: failed to read {} - {}: {}".format(
+                    ap.name, current_start_ts, end_ts, e
+                )
+            )
+            failed.append((current_start_ts, end_ts))
+            break
+        except Exception as e:
+            if current_end_ts - current_start_ts > INTERVAL_MS:
+                chunk = max(
+                    INTERVAL_MS,
+                    (current_end_ts - current_start_ts)
+                    // 2
+                    // INTERVAL_MS
+                    * INTERVAL_MS,
+                )
+                log.debug(
+                    "{}: failed to read {} - {}, reading by {} h: {}".format(
+                        ap.name,
+                        current_start_ts,
+                        current_end_ts,
+                        chunk // INTERVAL_MS,
+                        e,
+                    )
+                )
+                continue
+            failures += 1
+            if failures >= MAX_FAILURES:
+                log.warning(
+                    "{}: failed to read {} - {}, {} times in a row: {}".format(
+                        ap.name, current_start_ts, end_ts, failures, e
+                    )
+                )
+                failed.append((current_start_ts, end_ts))
+                break
+            log.warning(
+                "Failed to read value for interval {} - {} : {}".format(
+                    current_start_ts, current_end_ts, e
+                )
+            )
+            failed.append((current_start_ts, current_end_ts))
+        else:
+            failures = 0
+            data += chunk_data
+            if cache:
+                cache.store(
+                    ap.name, SERIES, current_start_ts, current_end_ts, chunk_data
+                )
+            chunk = min(chunk * 2, MAX_CHUNK_MS)
+        current_start_ts = current_end_ts
+    return data, n_requests, failed
+
+
+def fetch(client, start_ts, end_ts, job):
+    """
+    Reads the history of an AP, in a fetch thread: from Thingsboard, only
+    over the time ranges missing from the cache, if enabled.
+    Expects: job = (index, AP)
+
+    Returns: (index, AP, data, number of requests, [(start, end)] of the failed ranges).
+    """
+
+    i, ap = job
+    if not cache:
+        return (i, ap) + fetch_range(client, ap, start_ts, end_ts)
+
+    failed, n_requests = [], 0
+    for range_start, range_end in cache.missing(ap.name, SERIES, start_ts, end_ts):
+        _, n, range_failed = fetch_range(client, ap, range_start, range_end)
+        n_requests += n
+        failed += range_failed
+    return i, ap, cache.read(ap.name, SERIES, start_ts, end_ts), n_requests, failed
+
+
+def aggregate(aps, ap_index, ts, values):
+    """
+    Sums the hourly averages of all APs per hour and per day (local time),
+    with one groupby per period over all the samples.
+    Expects: columns of the samples: index of the AP in aps, ts (ms), value (Wh)
+
+    Returns: (hourly, daily) frames, one row per AP with data:
+    AP, Switch, Interface, then one column per period.
+    """
+
+    samples = pd.DataFrame(
+        {
+            "AP": np.frombuffer(ap_index, dtype=np.int64),
+            "Energy [Wh]": np.frombuffer(values, dtype=np.float64),
+        }
+    )
+    devices = pd.DataFrame(
+        {
+            "AP": [ap.name for ap in aps],
+            "Switch": [ap.attributes.get("switch") for ap in aps],
+            "Interface": [ap.attributes.get("interface") for ap in aps],
+        }
+    )
 
-    key = "PoE"
+    # Local time conversion of the distinct timestamps only: the samples
+    # are aligned on the interval, and the conversion is per element
+    timestamps, inverse = np.unique(
+        np.frombuffer(ts, dtype=np.int64), return_inverse=True
+    )
+    dates = (
+        pd.to_datetime(timestamps, unit="ms", utc=True)
+        .tz_convert(dateutil.tz.tzlocal())
+        .tz_localize(None)
+    )
 
-    # TODO(): Allow user input for start / mid / end
-    #  Get 2 chunks of data with average per h
-    #  2 weeks: Wed Apr 05 2023 14:00:00 GMT+0000 (1680703200000)
-    #          to Wed Apr 19 2023 14:00:00 GMT+0000 (1681912800000)
+    tables = []
+    for freq in ("h", "D"):
+        codes, periods = pd.factorize(dates.to_period(freq), sort=True)
+        samples["Date"] = codes[inverse]
+        energy = samples.groupby(["AP", "Date"])["Energy [Wh]"].sum().unstack("Date")
+        energy.columns = periods[energy.columns]
+        tables.append(devices.join(energy, how="inner"))
+    return tuple(tables)
 
-    start_ts = 1680703200000
-    mid_ts = 1681308000000
-    end_ts = 1681912800000
 
-    factor = 3600000
-    nr_h = (end_ts - start_ts) / factor
-    h = 1
+def read(client, aps):
+    global limiter, cache
+
+    key = KEY
 
     time_tag = (
         str(datetime.datetime.fromtimestamp(start_ts / 1000))
@@ -75,142 +292,99 @@ def read(client, aps):
     output_file_json = key + output_file + ".json"
     output_file_excel = "energy-data-daily-" + time_tag + ".xlsx"
     output_file_excel_hourly = "energy" + output_file + ".xlsx"
+    output_file_failed = "failed-ranges-" + time_tag + ".json"
     sheet = "APs-day-to-day"
     sheet_hourly = "APs-hour-by-hour"
 
-    with open("data/" + output_file_json, "w+") as fj:
-        with pd.ExcelWriter("data/" + output_file_excel, engine="xlsxwriter") as wfx:
-            with pd.ExcelWriter(
-                "data/" + output_file_excel_hourly, engine="xlsxwriter"
-            ) as wfx_hourly:
-                fj.write("[")
-                l = len(aps)
-
-                request_filters = "&interval=3600000&limit=10000&agg=AVG&keys=" + key
-
-                # TODO: read device IDs for all APs
-                for i, ap in enumerate(aps):
-                    log.info("{} - AP:{}".format(i, ap.name))
-
-                    try:
-                        data = (
-                            client.tb_read_historical_values(
-                                ap, str(start_ts), str(mid_ts), request_filters
-                            )[key]
-                            + client.tb_read_historical_values(
-                                ap, str(mid_ts), str(end_ts), request_filters
-                            )[key]
-                        )
-                    except Exception as e:
-                        log.warning(
-                            "Failed reading value: {} - will try to read hour-by-hour...".format(
-                                e
-                            )
-                        )
-                        h = 1
-                        hist = []
-                        current_start_ts = start_ts
-                        while h <= nr_h:
-                            current_end_ts = current_start_ts + factor
-                            try:
-                                hist += client.tb_read_historical_values(
-                                    ap,
-                                    str(current_start_ts),
-                                    str(current_end_ts),
-                                    request_filters,
-                                )[key]
-                            except Exception as e:
-                                log.warning(
-                                    "Failed to read value for interval {} - {} : {}".format(
-                                        current_start_ts, current_end_ts, e
-                                    )
-                                )
-                            h += 1
-                            current_start_ts = current_end_ts
-                        data = hist
-                        # time.sleep(30) # Sleep after making many requests to Tb - see rate limit
-
-                    try:
-                        if not data:
-                            raise Exception("No data for this device.")
-                        log.info(
-                            "{} - Sample read for {}: {}".format(i, ap.name, (data)[0])
-                        )
-
-                        # Export raw data to JSON file
-                        json.dump({ap.name: data}, fj)
-
-                        # Simplify timestamps to hourly timestamps
-                        data_daily = [
-                            {
-                                "Date": pd.Timestamp(
-                                    datetime.datetime.fromtimestamp(
-                                        e["ts"] / 1000
-                                    ).replace(hour=0, minute=0, second=0, microsecond=0)
-                                ).to_period(freq="d"),
-                                # Convert value field from string to float
-                                "Energy [Wh]": float(e["value"]),  # Assume Wh
-                            }
-                            for e in data
-                        ]
-                        data_hourly = [
-                            {
-                                "Date": pd.Timestamp(
-                                    datetime.datetime.fromtimestamp(
-                                        e["ts"] / 1000
-                                    ).replace(minute=0, second=0, microsecond=0)
-                                ).to_period(freq="h"),
-                                # Convert value field from string to float
-                                "Energy [Wh]": float(e["value"]),  # Assume Wh
-                            }
-                            for e in data
-                        ]
-
-                        # Hourly sample information
-                        pd_data_hourly = pd.DataFrame.from_records(
-                            data_hourly, index="Date"
-                        )
-                        pd_data_hourly = (
-                            pd_data_hourly.groupby("Date").sum().sort_values(["Date"]).T
-                        )
-                        log.info("{} - Sample hourly energy for {}:".format(i, ap.name))
-                        log.info((pd_data_hourly[0:2]))
-
-                        # Aggregate information: sum hourly energy consumption, grouped by day
-                        pd_data = pd.DataFrame.from_records(data_daily, index="Date")
-                        pd_data = pd_data.groupby("Date").sum().sort_values(["Date"]).T
-
-                        log.info("{} - Sample daily energy for {}:".format(i, ap.name))
-                        log.info((pd_data[0:2]))
-
-                        # Augment dataframe: append AP name
-                        pd_data_o = {"AP": ap.name}
-                        pd_data_o.update(pd_data)
-                        pd_data_o = pd.DataFrame(pd_data_o)
-                        pd_data_hourly_o = {"AP": ap.name}
-                        pd_data_hourly_o.update(pd_data_hourly)
-                        pd_data_hourly_o = pd.DataFrame(pd_data_hourly_o)
-
-                        # Export to XLSX the daily energy consumption for each AP: [AP, day1, day2, ...]
-                        if i == 0:
-                            pd_data_o.to_excel(wfx, sheet_name=sheet)
-                            pd_data_hourly_o.to_excel(
-                                wfx_hourly, sheet_name=sheet_hourly
-                            )
-                        else:
-                            pd_data_o.to_excel(
-                                wfx, sheet_name=sheet, header=False, startrow=i + 1
-                            )
-                            pd_data_hourly_o.to_excel(
-                                wfx_hourly,
-                                sheet_name=sheet_hourly,
-                                header=True,
-                                startrow=2 * i,
-                            )
-                    except Exception as e:
-                        log.warning("Error exporting data: {}".format(e))
-
-                fj.write("]")
+    limiter = RateLimiter(RATE)
+    if CACHE_FILE:
+        cache = HistoryCache(CACHE_FILE, REFRESH_MS, INTERVAL_MS)
+        if INVALIDATE_SINCE is not None:
+            cache.invalidate(INVALIDATE_AP, INVALIDATE_SINCE)
+    n_requests, points, failed_ranges = 0, 0, {}
+    fetch_start = time.perf_counter()
+
+    # Samples of all APs, as columns
+    ap_index, ts, values = array("q"), array("q"), array("d")
+
+    with open("data/" + output_file_json, "w+") as fj, ThreadPool(
+        processes=WORKERS
+    ) as p:
+        fj.write("[")
+
+        # Histories are fetched concurrently, and collected in the order
+        # of the APs as they arrive
+        for i, ap, data, n, failed in p.imap(
+            functools.partial(fetch, client, start_ts, end_ts),
+            enumerate(aps),
+        ):
+            log.info("{} - AP:{}".format(i, ap.name))
+            n_requests += n
+            points += len(data)
+            if failed:
+                failed_ranges[ap.name] = failed
+
+            try:
+                if not data:
+                    raise Exception("No data for this device.")
+                log.info("{} - Sample read for {}: {}".format(i, ap.name, (data)[0]))
+
+                # Export raw data to JSON file
+                json.dump({ap.name: data}, fj)
+
+                # Convert value field from string to float, assume Wh
+                values.extend([float(e["value"]) for e in data])
+                ts.extend([e["ts"] for e in data])
+                ap_index.extend([i] * len(data))
+            except Exception as e:
+                log.warning("Error exporting data: {}".format(e))
+
+        fj.write("]")
+    if cache:
+        cache.close()
+
+    duration_s = time.perf_counter() - fetch_start
+    log.info(
+        "Read %i points of %i APs with %i requests in %.1fs"
+        + " (%.1f APs/s, %.1f requests/s)",
+        points,
+        len(aps),
+        n_requests,
+        duration_s,
+        len(aps) / duration_s if duration_s else 0,
+        n_requests / duration_s if duration_s else 0,
+    )
+
+    # Energy consumption of each AP: [AP, Switch, Interface, hour1/day1, ...]
+    aggregate_start = time.perf_counter()
+    pd_data_hourly, pd_data = aggregate(aps, ap_index, ts, values)
+    log.info(
+        "Aggregated %i samples of %i APs in %.1fs",
+        len(values),
+        len(pd_data),
+        time.perf_counter() - aggregate_start,
+    )
+    log.info("Sample hourly energy:")
+    log.info(pd_data_hourly[0:2])
+    log.info("Sample daily energy:")
+    log.info(pd_data[0:2])
+
+    # Export to XLSX
+    with pd.ExcelWriter("data/" + output_file_excel, engine="xlsxwriter") as wfx:
+        pd_data.to_excel(wfx, sheet_name=sheet, index=False)
+    with pd.ExcelWriter(
+        "data/" + output_file_excel_hourly, engine="xlsxwriter"
+    ) as wfx_hourly:
+        pd_data_hourly.to_excel(wfx_hourly, sheet_name=sheet_hourly, index=False)
+    if failed_ranges:
+        with open("data/" + output_file_failed, "w") as ff:
+            json.dump(failed_ranges, ff)
+        log.warning(
+            "Failed to read %i ranges of %i APs, see %s",
+            sum(len(f) for f in failed_ranges.values()),
+            len(failed_ranges),
+            "data/" + output_file_failed,
+        )
     return []
 
 
@@ -220,6 +394,9 @@ def export(data, file):
 
 
 def main(argv):
+    global WORKERS, RATE, CHUNK_MS, CACHE_FILE, REFRESH_MS, start_ts, end_ts
+    global INVALIDATE_SINCE, INVALIDATE_AP
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-t",
@@ -244,6 +421,77 @@ def main(argv):
         required=False,
         help="XLSX file for saving the data",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        required=False,
+        default=WORKERS,
+        help="Number of APs whose history is read concurrently",
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        required=False,
+        default=RATE,
+        help="Maximum number of requests per second to Thingsboard",
+    )
+    parser.add_argument(
+        "-s",
+        "--start",
+        type=parse_ts,
+        required=False,
+        help="Start of the time range, epoch ms or ISO date (default: {} weeks"
+        " before the end)".format(WEEKS),
+    )
+    parser.add_argument(
+        "-e",
+        "--end",
+        type=parse_ts,
+        required=False,
+        help="End of the time range, epoch ms or ISO date (default: last full hour)",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk_hours",
+        type=int,
+        required=False,
+        default=CHUNK_MS // INTERVAL_MS,
+        help="Time range of the first request of each AP, adapted to failures",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        default=CACHE_FILE,
+        help="SQLite file of the local history cache",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Read the whole time range from Thingsboard, without cache",
+    )
+    parser.add_argument(
+        "--refresh_hours",
+        type=int,
+        required=False,
+        default=REFRESH_MS // INTERVAL_MS,
+        help="Recent hours of history read again by the next run",
+    )
+    parser.add_argument(
+        "--invalidate_since",
+        type=parse_ts,
+        required=False,
+        help="Read the cached history again since this time, epoch ms or ISO"
+        " date, e.g. after values were corrected in Thingsboard",
+    )
+    parser.add_argument(
+        "--invalidate_ap",
+        type=str,
+        required=False,
+        help="AP whose cached history is read again (default: all APs)",
+    )
     args = parser.parse_args(argv)
 
     if not args.tb_file:
@@ -252,6 +500,20 @@ def main(argv):
         )
     if not args.aps_file:
         log.info("Using default APs file in: " + "/onboard/yaml/aps.yml")
+    WORKERS, RATE = args.workers, args.rate
+    CHUNK_MS = args.chunk_hours * INTERVAL_MS
+    CACHE_FILE = None if args.no_cache else args.cache
+    REFRESH_MS = args.refresh_hours * INTERVAL_MS
+    INVALIDATE_SINCE, INVALIDATE_AP = args.invalidate_since, args.invalidate_ap
+    if INVALIDATE_AP and INVALIDATE_SINCE is None:
+        INVALIDATE_SINCE = 0
+
+    # Time range aligned on the interval, as the cached ranges
+    end_ts = (args.end or int(time.time() * 1000)) // INTERVAL_MS * INTERVAL_MS
+    start_ts = args.start or end_ts - WEEKS * 7 * 24 * INTERVAL_MS
+    start_ts = start_ts // INTERVAL_MS * INTERVAL_MS
+    if start_ts >= end_ts:
+        parser.error("--start must be before --end")
     return args.tb_file, args.aps_file, args.xlsx
 
 
@@ -271,6 +533,9 @@ if __name__ == "__main__":
             [(a, TbEntityType.DEVICE, TbDeviceType.AP) for a in aps.items()],
         )
 
+    # Switch ports of the APs, as last seen by the switch collectors
+    Topology.load().annotate(devices_aps)
+
     os.makedirs("data", exist_ok=True)
     data = read(rest_client, devices_aps)
     export(data, xlsx_file)
@@ -73,6 +73,8 @@ For real environment
 - zones file            /onboard/yaml/zones.yml
 - APs file              /onboard/yaml/aps.yml (optional)
 - switches file         /onboard/yaml/switches.yml.
+- topology index        /topology/topology.json (optional, env variable
+                        TOPOLOGY_FILE), switch ports of the APs
 
 Assumes:
 - settings file: onboard/settings.ini or environment variable SETTINGS_FILE
@@ -100,6 +102,7 @@ from utils import tbyaml
 from utils.logger import log
 from utils.config import config
 from utils.tbclient import TbRestClient
+from utils.topology import Topology
 from utils.tbentity import TbEntity, TbAsset
 from utils.tbentity import TbEntityType, TbAssetType, TbDeviceType
 
@@ -222,6 +225,9 @@ def main():
 
                 log.info("AP devices: %s", [device.name for device in devices_aps])
 
+                # Switch ports of the APs, as last seen by the switch collectors
+                Topology.load().annotate(devices_aps)
+
                 # Define the devices with Thingsboard API
                 _ = [rest_client.tb_create_device(device) for device in devices_aps]
 
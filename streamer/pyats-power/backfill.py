@@ -0,0 +1,386 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Backfills Thingsboard with the samples archived on the local disk,
+e.g. after the broker or the streamers were down.
+
+Sources, for a time range:
+- APs' PoE: the PoE details under /streamer/pyats-power/output, from the
+  segment stores (history) and the latest files, mapped to the APs by the
+  topology index (or else the CDP neighbors) as it is now
+- switches: the "show env all" and "show power inline" outputs archived
+  under /streamer/pyats-power/extra-output (streamer_collector,
+  streamer_switches, streamer_switches_extra), as files or in the archive,
+  as flat telemetry (see utils/power.py)
+
+For each device, the samples stored in Thingsboard over the range are read,
+and only the missing points are uploaded, in time-ordered batches over the
+REST API. A value is missing if its key has no stored sample within
+--gap-minutes (default 10) of it: the archives are not sampled at the
+timestamps of the live telemetry (e.g. hourly extra outputs against the
+5-minute cycles of streamer_switches), so only real gaps are filled.
+Devices are processed in parallel, under a rate limit of the
+requests shared by the threads.
+
+Progress is saved in a checkpoint file after every batch: a run over the
+same time range resumes after the last batch uploaded for each device.
+
+Expects:
+- Thingsboard file       /onboard/thingsboard.yml
+
+Run example:
+  cd <main folder>
+  pip3 install -r streamer/pyats-power/requirements.txt
+
+  python3.9 -m streamer.pyats-power.backfill \
+    --tbfile=onboard/thingsboard.yml --start=1681308000000 --end=1681912800000 \
+    [--workers=8] [--rate=10] [--batch=1000] [--gap-minutes=10] \
+    [--checkpoint=<file>] [--dry-run]
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import getopt
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+from ..utils import local
+from ..utils import power
+from ..utils.logger import log
+from ..utils.topology import Topology
+from ..utils.outputindex import OutputIndex
+from ..utils.ratelimit import RateLimiter
+from ..utils.segments import SegmentStore
+from ..utils.tbclient import TbRestClient
+from ..utils.tbentity import TbDevice, TbEntityType
+
+# Set default paths
+tb_file = "/onboard/thingsboard.yml"
+ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+CHECKPOINT_FILE = os.path.join(os.path.dirname(__file__), "state", "backfill.json")
+
+DRY_RUN = False  # Set to true to report the missing points only
+WORKERS = 8  # Devices processed in parallel
+RATE = 10  # Requests per second to Thingsboard
+BATCH = 1000  # Points per upload
+WINDOW_MS = 24 * 3600 * 1000  # Time window of the reads of stored samples
+READ_LIMIT = 100000  # Samples per key and window read
+GAP_MS = 10 * 60 * 1000  # Distance to the nearest stored sample of a missing value
+
+
+class Checkpoint:
+    """A class that saves the progress of a backfill of a time range."""
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.range = [start, end]
+        self.devices = {}  # device -> ts of the last point uploaded
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                content = json.load(fp)
+            if content["range"] == self.range:
+                self.devices = content["devices"]
+                log.info("Resuming the backfill of %i devices", len(self.devices))
+            else:
+                log.info("Ignoring checkpoint of range %s", content["range"])
+
+    def get(self, device, default):
+        return self.devices.get(device, default)
+
+    def save(self, device, ts):
+        with self._lock:
+            self.devices[device] = ts
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump({"range": self.range, "devices": self.devices}, fp)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def ap_neighbors(topology, switch):
+    """Returns: [(AP, interface)] of a switch, from the topology or the CDP files."""
+
+    if switch in topology.switches:
+        return topology.switch(switch)
+    cdp_dir = os.path.join(ON_PREM_OUTPUT_DIR, switch, "show_cdp_neighbors")
+    if not os.path.isdir(cdp_dir):
+        return []
+    names = [f for f in os.listdir(cdp_dir) if f.isdigit()]
+    if not names:
+        return []
+    return local.read_cdp_neigbors(
+        (switch, os.path.join(cdp_dir, max(names, key=int)))
+    )[1]
+
+
+def detail_files(device_dir, interfaces, start, end):
+    """
+    Reads the latest PoE details files over a time range, by their names.
+
+    Returns: generator of (interface, ts, data).
+    """
+
+    for interface in interfaces:
+        interface_dir = os.path.join(
+            device_dir, "show_power_inline_" + interface + "_detail"
+        )
+        if not os.path.isdir(interface_dir):
+            continue
+        for name in os.listdir(interface_dir):
+            if name.isdigit() and start <= int(name) <= end:
+                with open(os.path.join(interface_dir, name), encoding="utf-8") as fp:
+                    yield (interface, int(name), json.load(fp))
+
+
+def ap_samples(start, end):
+    """Returns: {AP: {ts: {"PoE": value}}} archived over the time range."""
+
+    topology = Topology.load()
+    samples = {}
+    if not os.path.isdir(ON_PREM_OUTPUT_DIR):
+        return samples
+    for switch in os.listdir(ON_PREM_OUTPUT_DIR):
+        device_dir = os.path.join(ON_PREM_OUTPUT_DIR, switch)
+        aps = {interface: ap for ap, interface in ap_neighbors(topology, switch)}
+
+        # Read lazily, only the files and segments over the range
+        records = detail_files(device_dir, aps, start, end)
+        if SegmentStore.exists(device_dir):
+            records = itertools.chain(
+                records, SegmentStore(device_dir).history(start=start, end=end)
+            )
+        for interface, ts, data in records:
+            if interface not in aps:
+                continue
+            try:
+                value = float(data["interface"][interface]["measured_consumption"])
+            except (KeyError, TypeError):
+                continue
+            samples.setdefault(aps[interface], {})[int(ts)] = {"PoE": value}
+
+    return samples
+
+
+def switch_samples(start, end):
+    """Returns: {switch member: {ts: values}} archived over the time range."""
+
+    # Outputs of both stores, files and archive, by time range
+    index = OutputIndex(EXTRA_OUTPUT_DIR)
+    index.update()
+    payloads = {}  # (device, ts) -> payload
+    for device in index.devices():
+        for archive_name, command in power.ARCHIVED_COMMANDS.items():
+            for ts, out in index.query(device, archive_name, start, end):
+                payload = payloads.setdefault(
+                    (device, ts), {"device": device, "date": ts}
+                )
+                payload[command] = out
+    if not payloads:
+        log.warning(
+            "No archived switch outputs between %i and %i under %s, archived by"
+            + " streamer_collector, streamer_switches (--extra-store) and"
+            + " streamer_switches_extra",
+            start,
+            end,
+            EXTRA_OUTPUT_DIR,
+        )
+
+    samples = {}
+    for payload in payloads.values():
+        try:
+            json_body = power.switch_telemetry(payload)
+        except Exception as e:
+            log.warning("Cannot read the archive of %s: %s", payload["device"], e)
+            continue
+        for member, points in json_body.items():
+            for point in points:
+                samples.setdefault(member, {})[point["ts"]] = point["values"]
+
+    return samples
+
+
+def stored_keys(device, keys, start, end):
+    """Returns: {key: [ts, ...] in time order} stored in Thingsboard over a range."""
+
+    stored = {}
+    for window_start in range(start, end + 1, WINDOW_MS):
+        window_end = min(window_start + WINDOW_MS - 1, end)
+        limiter.wait()
+        values = client.tb_read_historical_values(
+            device,
+            str(window_start),
+            str(window_end),
+            "&agg=NONE&limit={}&keys={}".format(READ_LIMIT, ",".join(sorted(keys))),
+        )
+        if values == -1:
+            raise IOError("Cannot read the stored samples of " + device.name)
+        for key, points in values.items():
+            stored.setdefault(key, []).extend(point["ts"] for point in points)
+
+    for timestamps in stored.values():
+        timestamps.sort()
+    return stored
+
+
+def is_stored(stored, key, ts):
+    """Returns: true if a sample of the key is stored within GAP_MS of ts."""
+
+    timestamps = stored.get(key, [])
+    i = bisect.bisect_left(timestamps, ts - GAP_MS)
+    return i < len(timestamps) and timestamps[i] <= ts + GAP_MS
+
+
+def backfill(job):
+    """
+    Uploads the points of a device that Thingsboard does not store.
+    Expects: job = (device name, {ts: values})
+
+    Returns: number of points missing (uploaded unless dry run).
+    """
+
+    name, points = job
+    device = TbDevice(name, TbEntityType.DEVICE)
+    done = checkpoint.get(name, -1)
+    points = {ts: values for ts, values in points.items() if ts > done}
+    if not points:
+        return 0
+
+    try:
+        limiter.wait()
+        if client.tb_get_entity_id(device) == -1:
+            log.warning("Skipping %s, not defined in Thingsboard", name)
+            return 0
+        keys = set().union(*points.values())
+        stored = stored_keys(device, keys, min(points) - GAP_MS, max(points) + GAP_MS)
+    except Exception as e:
+        log.error("Skipping %s: %s", name, e)
+        return 0
+
+    missing = []
+    for ts in sorted(points):
+        values = {
+            key: value
+            for key, value in points[ts].items()
+            if not is_stored(stored, key, ts)
+        }
+        if values:
+            missing.append({"ts": ts, "values": values})
+    log.info("%s: %i of %i points missing", name, len(missing), len(points))
+    if DRY_RUN:
+        return len(missing)
+
+    for i in range(0, len(missing), BATCH):
+        batch = missing[i : i + BATCH]
+        limiter.wait()
+        if not client.tb_save_timeseries(device, batch):
+            log.error("Stopping the backfill of %s at %s", name, batch[0]["ts"])
+            return i
+        checkpoint.save(name, batch[-1]["ts"])
+
+    return len(missing)
+
+
+def main(argv):
+    """Parses arguments and loads metadata."""
+
+    global tb_file, CHECKPOINT_FILE, DRY_RUN, WORKERS, RATE, BATCH, GAP_MS
+    global start, end
+
+    end = int(time.time_ns() / 1000000)
+    start = end - WINDOW_MS
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "t:",
+            [
+                "tbfile=",
+                "start=",
+                "end=",
+                "workers=",
+                "rate=",
+                "batch=",
+                "gap-minutes=",
+                "checkpoint=",
+                "dry-run",
+            ],
+        )
+    except getopt.GetoptError:
+        log.error(
+            "backfill.py --tbfile=<thingsboard.yml> --start=<ms> --end=<ms>"
+            + " [--workers=<threads>] [--rate=<requests/s>] [--batch=<points>]"
+            + " [--gap-minutes=<minutes>] [--checkpoint=<file>] [--dry-run]"
+        )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-t", "--tbfile"):
+            tb_file = arg
+        if opt == "--start":
+            start = int(arg)
+        if opt == "--end":
+            end = int(arg)
+        if opt == "--workers":
+            WORKERS = int(arg)
+        if opt == "--rate":
+            RATE = float(arg)
+        if opt == "--batch":
+            BATCH = int(arg)
+        if opt == "--gap-minutes":
+            GAP_MS = int(arg) * 60 * 1000
+        if opt == "--checkpoint":
+            CHECKPOINT_FILE = arg
+        if opt == "--dry-run":
+            DRY_RUN = True
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    api = yaml.load(open(tb_file, encoding="utf-8"), Loader=yaml.Loader)["api"]
+    client = TbRestClient(api)
+    limiter = RateLimiter(RATE)
+    checkpoint = Checkpoint(CHECKPOINT_FILE, start, end)
+
+    # Samples archived over the time range, per device
+    samples = ap_samples(start, end)
+    samples.update(switch_samples(start, end))
+    log.info(
+        "Archived: %i points of %i devices",
+        sum(len(points) for points in samples.values()),
+        len(samples),
+    )
+
+    backfill_start = time.perf_counter()
+    with ThreadPool(processes=WORKERS) as p:
+        counts = p.map(backfill, samples.items())
+    duration_s = time.perf_counter() - backfill_start
+
+    log.info(
+        "%s %i points of %i devices in %.1fs (%.1f points/s)",
+        "Missing" if DRY_RUN else "Uploaded",
+        sum(counts),
+        len([c for c in counts if c]),
+        duration_s,
+        sum(counts) / duration_s if duration_s else 0,
+    )
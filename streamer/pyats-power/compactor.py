@@ -0,0 +1,162 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Keeps the output directories of the streamers within their retention
+policies (see utils/retention.py and onboard/retention.yml), by category:
+- cdp: the CDP neighbors snapshots under /streamer/pyats-power/output
+- extra: the outputs of the files store under
+  /streamer/pyats-power/extra-output; the archive store is compacted by
+  its writers (--store=archive, --extra-store=archive)
+- timings: the daily timing files of streamer_collector
+
+Old outputs are rolled into compressed daily bundles, then removed past
+their maximum age or over the maximum size of the category. For each
+category, the space reclaimed and the time to list its directories
+before and after are logged.
+
+Bundled outputs are still read by the time index (query.py, backfill.py,
+reprocess.py), but no longer by reparse.py: its --force does not parse
+them again. Set bundle_after_days of the extra category beyond the age
+of the outputs to parse again, or leave it unset.
+
+Cadence: 24h.
+
+Run example:
+  cd <main folder>
+
+  python3.9 -m streamer.pyats-power.compactor \
+    [--policies=onboard/retention.yml] [--once] [--every=<s>]
+
+Run example as a service:
+  cd <main folder>
+  docker-compose up -d compactor
+"""
+
+import os
+import sys
+import glob
+import time
+import getopt
+
+from ..utils import retention
+from ..utils.logger import log
+from ..utils.archive import BLOBS_DIR
+from ..utils.outputindex import OutputIndex
+from ..utils.retention import RetentionPolicy
+
+ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+TIMINGS_DIR = os.path.join(os.path.dirname(__file__), "timings")
+
+policies_file = retention.RETENTION_FILE
+ONCE = False  # Set to true to apply the policies once and exit
+EVERY_S = 24 * 3600  # Period of the runs
+
+
+def directories(category):
+    """Returns: output directories of a category."""
+
+    if category == "cdp":
+        paths = glob.glob(os.path.join(ON_PREM_OUTPUT_DIR, "*", "show_cdp_neighbors"))
+    elif category == "extra":
+        paths = [
+            path
+            for path in glob.glob(os.path.join(EXTRA_OUTPUT_DIR, "*", "*"))
+            if os.path.basename(os.path.dirname(path)) != BLOBS_DIR
+        ]
+    elif category == "timings":
+        paths = [TIMINGS_DIR]
+    else:
+        log.warning("Unknown retention category %s", category)
+        paths = []
+    return [path for path in paths if os.path.isdir(path)]
+
+
+def listing_ms(paths):
+    """Returns: duration (ms) of the listing of the directories."""
+
+    start = time.perf_counter()
+    for path in paths:
+        os.listdir(path)
+    return (time.perf_counter() - start) * 1000
+
+
+def compact(category, policy):
+    """Applies the retention policy of a category, logs its effect."""
+
+    paths = directories(category)
+    before_ms = listing_ms(paths)
+    report = policy.apply(paths, int(time.time_ns() / 1000000))
+    after_ms = listing_ms(paths)
+
+    # Forget the outputs removed from the time index of extra-output
+    if category == "extra":
+        index = OutputIndex(EXTRA_OUTPUT_DIR)
+        for path in paths:
+            device = os.path.basename(os.path.dirname(path))
+            oldest = retention.oldest(path)
+            if oldest is not None:
+                index.drop_before(device, os.path.basename(path), oldest)
+
+    log.info(
+        "Retention of %s: %i directories, %i -> %i files, reclaimed %.1f of"
+        + " %.1f MB, listing %.1f -> %.1f ms",
+        category,
+        len(paths),
+        report["files"],
+        report["remaining"],
+        report["reclaimed"] / 1024 / 1024,
+        report["bytes"] / 1024 / 1024,
+        before_ms,
+        after_ms,
+    )
+
+
+def main(argv):
+    """Parses arguments."""
+
+    global policies_file, ONCE, EVERY_S
+
+    try:
+        opts, args = getopt.getopt(argv, "p:", ["policies=", "once", "every="])
+    except getopt.GetoptError:
+        log.error("compactor.py [--policies=<retention.yml>] [--once] [--every=<s>]")
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-p", "--policies"):
+            policies_file = arg
+        if opt == "--once":
+            ONCE = True
+        if opt == "--every":
+            EVERY_S = int(arg)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    policies = RetentionPolicy.load(policies_file)
+
+    while True:
+        for category, policy in policies.items():
+            try:
+                compact(category, policy)
+            except OSError as e:
+                log.error("Retention of %s failed: %s", category, e)
+
+        if ONCE:
+            break
+        time.sleep(EVERY_S)
@@ -0,0 +1,97 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Prints the outputs of a command of a switch archived under
+/streamer/pyats-power/extra-output over a time range, in time order, one
+JSON line each: {"device": ..., "command": ..., "ts": ..., "output": ...}
+
+Outputs of both stores (files and archive) are read through the time index
+of utils/outputindex.py, updated first unless --no-update.
+
+Run example:
+  cd <main folder>
+
+  python3.9 -m streamer.pyats-power.query \
+    --device=<switch> --command="show power total" \
+    [--start=<ms>] [--end=<ms>] [--format=json|cli] [--no-update]
+"""
+
+import os
+import sys
+import json
+import getopt
+
+from ..utils.logger import log
+from ..utils.outputindex import OutputIndex
+
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+
+UPDATE = True  # Set to false to query the index as it is
+device = None
+command = None
+start = 0
+end = None
+fmt = "json"
+
+
+def main(argv):
+    """Parses arguments."""
+
+    global device, command, start, end, fmt, UPDATE
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "d:c:",
+            ["device=", "command=", "start=", "end=", "format=", "no-update"],
+        )
+    except getopt.GetoptError:
+        log.error(
+            "query.py --device=<switch> --command=<command> [--start=<ms>]"
+            + " [--end=<ms>] [--format=json|cli] [--no-update]"
+        )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-d", "--device"):
+            device = arg
+        if opt in ("-c", "--command"):
+            command = arg
+        if opt == "--start":
+            start = int(arg)
+        if opt == "--end":
+            end = int(arg)
+        if opt == "--format":
+            fmt = arg
+        if opt == "--no-update":
+            UPDATE = False
+
+    if not device or not command:
+        log.error("Missing --device or --command")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    index = OutputIndex(EXTRA_OUTPUT_DIR)
+    if UPDATE:
+        index.update([device])
+
+    for ts, out in index.query(device, command, start, end, fmt):
+        print(
+            json.dumps({"device": device, "command": command, "ts": ts, "output": out})
+        )
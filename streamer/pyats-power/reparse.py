@@ -0,0 +1,187 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Regenerates the JSON files of the raw CLI outputs (.cli) archived under
+/streamer/pyats-power/extra-output, by streamer_switches_extra with
+--capture-only or by streamer_collector.
+
+By default, only the outputs without JSON file are parsed; with --force,
+all of them, e.g. after an upgrade of the genie parsers. Parsing runs in a
+process pool, JSON files are replaced atomically.
+Outputs rolled into daily bundles by the compactor are not parsed again.
+Neither are the outputs stored in the archive (--store=archive or
+--extra-store=archive, see utils/archive.py): its manifests are in time
+order, and JSON records of past outputs cannot be appended to them. The
+switches with an archive are logged and only their files are parsed.
+
+The OS of each switch is read from the testbed file, --os otherwise.
+
+Run example:
+  cd <main folder>
+  pip3 install -r streamer/pyats-power/requirements.txt
+
+  python3.9 -m streamer.pyats-power.reparse \
+    --testbedyml=onboard/testbed.yml [--os=iosxe] [--since=<ms>] [--force] \
+    [--parse-workers=<processes>]
+"""
+
+import os
+import sys
+import time
+import json
+import getopt
+from multiprocessing import Pool
+
+from pyats.topology import loader
+import pyats.utils.yaml.exceptions
+
+from ..utils import parsing
+from ..utils.logger import log
+from ..utils.archive import BLOBS_DIR, MANIFEST_FILE
+
+# Set default paths
+testbed_file = "/onboard/testbed.yml"
+ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+
+DEFAULT_OS = "iosxe"  # OS of the switches missing from the testbed
+FORCE = False  # Set to true to parse again the outputs with JSON file
+SINCE = 0  # Timestamp (ms) of the oldest outputs parsed
+PARSE_WORKERS = os.cpu_count()  # Processes parsing CLI outputs
+device_oses = {}  # switch -> OS, from the testbed
+
+
+def find_outputs():
+    """Returns: jobs for reparse, [(OS, command, path of the .cli file)]."""
+
+    jobs, archived = [], []
+    for device in os.listdir(ON_PREM_OUTPUT_DIR):
+        device_dir = os.path.join(ON_PREM_OUTPUT_DIR, device)
+        if device.startswith(".") or device == BLOBS_DIR:
+            continue
+        if not os.path.isdir(device_dir):
+            continue
+        if os.path.exists(os.path.join(device_dir, MANIFEST_FILE)):
+            archived.append(device)
+        for command_dir in os.listdir(device_dir):
+            if command_dir.startswith("."):  # e.g. the time index
+                continue
+            if not os.path.isdir(os.path.join(device_dir, command_dir)):
+                continue
+            command = " ".join(command_dir.split("_"))
+            for name in os.listdir(os.path.join(device_dir, command_dir)):
+                ts = name[: -len(".cli")]
+                if not name.endswith(".cli") or not ts.isdigit() or int(ts) < SINCE:
+                    continue
+                path = os.path.join(device_dir, command_dir, name)
+                if not FORCE and os.path.exists(path[: -len(".cli")] + ".json"):
+                    continue
+                jobs.append((device_oses.get(device, DEFAULT_OS), command, path))
+
+    if archived:
+        log.info(
+            "Not parsing the archived outputs of %i switches: %s",
+            len(archived),
+            ", ".join(sorted(archived)),
+        )
+    return jobs
+
+
+def reparse(job):
+    """
+    Parses a raw CLI output and saves it next to it as JSON.
+    Expects: job = (OS, command, path of the .cli file)
+
+    Returns: True if saved, False if not parsed.
+    """
+
+    device_os, command, path = job
+    try:
+        with open(path, encoding="utf-8") as fp:
+            out = parsing.parse_output((device_os, command, fp.read()))
+    except Exception as e:
+        log.warning("Failed to parse %s: %s", path, e)
+        return False
+    if out is None:
+        return False
+
+    # Replace atomically: readers never see a partial JSON file
+    json_path = path[: -len(".cli")] + ".json"
+    with open(json_path + ".tmp", "w", encoding="utf-8") as fp:
+        fp.write(json.dumps(out, indent=2))
+    os.replace(json_path + ".tmp", json_path)
+    return True
+
+
+def main(argv):
+    """Parses arguments and loads metadata."""
+
+    global testbed_file, device_oses, DEFAULT_OS, FORCE, SINCE, PARSE_WORKERS
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "t:",
+            ["testbedyml=", "os=", "since=", "force", "parse-workers="],
+        )
+    except getopt.GetoptError:
+        log.error(
+            "reparse.py --testbedyml=<testbedsyml> [--os=<os>] [--since=<ms>]"
+            + " [--force] [--parse-workers=<processes>]"
+        )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-t", "--testbedyml"):
+            testbed_file = arg
+        if opt == "--os":
+            DEFAULT_OS = arg
+        if opt == "--since":
+            SINCE = int(arg)
+        if opt == "--force":
+            FORCE = True
+        if opt == "--parse-workers":
+            PARSE_WORKERS = int(arg)
+
+    # Load the OS of the switches from the testbed file
+    try:
+        testbed = loader.load(testbed_file)
+        device_oses = {str(name): d.os for name, d in testbed.devices.items()}
+    except pyats.utils.yaml.exceptions.LoadError as error:
+        log.warning("Failed to load testbed file, using OS %s: %s", DEFAULT_OS, error)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    jobs = find_outputs()
+    commands = {command for _, command, _ in jobs}
+    log.info("Parsing %i outputs of %i commands", len(jobs), len(commands))
+
+    start = time.perf_counter()
+    with Pool(
+        processes=PARSE_WORKERS,
+        initializer=parsing.init_worker,
+        initargs=(set(device_oses.values()) | {DEFAULT_OS}, commands),
+    ) as p:
+        saved = sum(p.imap_unordered(reparse, jobs, chunksize=16))
+    duration_s = time.perf_counter() - start
+
+    log.info(
+        "Saved %i JSON files, %i outputs not parsed, in %.1fs",
+        saved,
+        len(jobs) - saved,
+        duration_s,
+    )
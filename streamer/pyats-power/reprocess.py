@@ -0,0 +1,371 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Rebuilds the switch telemetry of a time range from the outputs archived
+under /streamer/pyats-power/extra-output (files or archive store, written by
+streamer_collector, streamer_switches and streamer_switches_extra), through
+the current transformation (see utils/power.py), e.g. after a fix of the
+per-member values.
+
+The range is cut into chunks (default: 1 day) per switch, transformed in
+a process pool and written in time order to a sink:
+- file: JSON lines {"device": ..., "ts": ..., "values": {...}}
+- tb: Thingsboard's REST API, replacing the stored values of the same
+  timestamps, under a rate limit
+
+With the ports schema, the attributes (powered devices) are left to the
+streamers: they hold current values. The compact schema is not supported:
+its arrays of past points would be read in the current order of the
+ports, which may have changed since.
+
+With --raw, the raw CLI outputs are parsed again instead of reading the
+archived JSON outputs; the OS of each switch is read from the testbed
+file, --os otherwise. Throughput is logged in records (archived outputs)
+and points per second.
+
+Expects:
+- Thingsboard file       /onboard/thingsboard.yml (tb sink)
+
+Run example:
+  cd <main folder>
+  pip3 install -r streamer/pyats-power/requirements.txt
+
+  python3.9 -m streamer.pyats-power.reprocess \
+    --start=1681308000000 --end=1681912800000 [--sink=file|tb] \
+    [--output=<file>] [--tbfile=onboard/thingsboard.yml] \
+    [--schema=flat|ports] [--raw] [--testbedyml=onboard/testbed.yml] [--os=iosxe] \
+    [--workers=<processes>] [--chunk-hours=24] [--rate=10] [--batch=1000]
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+from multiprocessing import Pool
+
+import yaml
+from pyats.topology import loader
+import pyats.utils.yaml.exceptions
+
+from ..utils import power
+from ..utils import parsing
+from ..utils.logger import log
+from ..utils.outputindex import OutputIndex
+from ..utils.ratelimit import RateLimiter
+from ..utils.tbclient import TbRestClient
+from ..utils.tbentity import TbDevice, TbEntityType
+
+# Set default paths
+tb_file = "/onboard/thingsboard.yml"
+testbed_file = "/onboard/testbed.yml"
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+OUTPUT_FILE = os.path.join(os.path.dirname(__file__), "state", "reprocessed.jsonl")
+
+SINK = "file"  # Destination of the telemetry: file or tb
+SCHEMA = "flat"  # Telemetry schema, see utils/power.py
+RAW = False  # Set to true to parse the raw CLI outputs again
+DEFAULT_OS = "iosxe"  # OS of the switches missing from the testbed
+WORKERS = os.cpu_count()  # Processes transforming the chunks
+CHUNK_MS = 24 * 3600 * 1000  # Time range of a chunk of a switch
+RATE = 10  # Requests per second to Thingsboard
+BATCH = 1000  # Points per upload
+PROGRESS_S = 10  # Period of the progress logs
+device_oses = {}  # switch -> OS, from the testbed
+
+index = None  # Index of the archived outputs, per worker
+
+
+class FileSink:
+    """A class that writes telemetry as JSON lines, replaced atomically on close."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fp = open(path + ".tmp", "w", encoding="utf-8")
+
+    def write(self, collection):
+        """Returns: number of points written."""
+
+        points = 0
+        for device, samples in collection.items():
+            for sample in samples:
+                self._fp.write(
+                    json.dumps(
+                        {
+                            "device": device,
+                            "ts": sample["ts"],
+                            "values": sample["values"],
+                        }
+                    )
+                    + "\n"
+                )
+            points += len(samples)
+        return points
+
+    def close(self):
+        self._fp.close()
+        os.replace(self.path + ".tmp", self.path)
+        log.info("Saved telemetry to %s", self.path)
+
+
+class TbSink:
+    """A class that saves telemetry over Thingsboard's REST API."""
+
+    def __init__(self, client, limiter, batch):
+        self.client = client
+        self.limiter = limiter
+        self.batch = batch
+        self.known = {}  # device -> True if defined in Thingsboard
+        self.failed = 0  # Points not saved
+
+    def _defined(self, device):
+        if device.name not in self.known:
+            self.limiter.wait()
+            self.known[device.name] = self.client.tb_get_entity_id(device) != -1
+            if not self.known[device.name]:
+                log.warning("Skipping %s, not defined in Thingsboard", device.name)
+        return self.known[device.name]
+
+    def write(self, collection):
+        """Returns: number of points saved."""
+
+        points = 0
+        for name, samples in collection.items():
+            device = TbDevice(name, TbEntityType.DEVICE)
+            if not self._defined(device):
+                continue
+            for i in range(0, len(samples), self.batch):
+                batch = samples[i : i + self.batch]
+                self.limiter.wait()
+                if self.client.tb_save_timeseries(device, batch):
+                    points += len(batch)
+                else:
+                    log.error("Failed to save %s from %s", name, batch[0]["ts"])
+                    self.failed += len(batch)
+        return points
+
+    def close(self):
+        if self.failed:
+            log.error("%i points not saved", self.failed)
+
+
+def init_worker(raw, oses, default_os):
+    """Initializes a worker process: index, and parsers of the raw outputs."""
+
+    global index, RAW, device_oses, DEFAULT_OS
+
+    index = OutputIndex(EXTRA_OUTPUT_DIR)
+    RAW, device_oses, DEFAULT_OS = raw, oses, default_os
+    if raw:
+        parsing.init_worker(
+            set(oses.values()) | {default_os}, list(power.ARCHIVED_COMMANDS)
+        )
+
+
+def transform(job):
+    """
+    Transforms the archived outputs of a switch over a chunk into telemetry.
+    Expects: job = (switch, start, end)
+
+    Returns: (number of archived outputs read, {device: [{"ts", "values"}]}).
+    """
+
+    device, start, end = job
+    payloads = {}  # ts -> payload
+    records = 0
+    for archive_name, command in power.ARCHIVED_COMMANDS.items():
+        for ts, out in index.query(
+            device, archive_name, start, end, "cli" if RAW else "json"
+        ):
+            records += 1
+            if RAW:
+                try:
+                    out = parsing.parse_output(
+                        (device_oses.get(device, DEFAULT_OS), archive_name, out)
+                    )
+                except Exception as e:
+                    log.warning("%s: cannot parse %s at %i: %s", device, command, ts, e)
+                    continue
+                if out is None:
+                    continue
+            payloads.setdefault(ts, {"device": device, "date": ts})[command] = out
+
+    collection = {}
+    for ts in sorted(payloads):
+        try:
+            json_body = power.switch_telemetry(payloads[ts])
+        except Exception as e:
+            log.warning("%s: cannot transform the outputs at %i: %s", device, ts, e)
+            continue
+        for member, points in json_body.items():
+            collection.setdefault(member, []).extend(points)
+
+    return records, collection
+
+
+def main(argv):
+    """Parses arguments."""
+
+    global tb_file, testbed_file, OUTPUT_FILE, SINK, SCHEMA, RAW, DEFAULT_OS
+    global device_oses, WORKERS, CHUNK_MS, RATE, BATCH, start, end
+
+    end = int(time.time_ns() / 1000000)
+    start = end - CHUNK_MS
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "t:",
+            [
+                "start=",
+                "end=",
+                "sink=",
+                "output=",
+                "tbfile=",
+                "schema=",
+                "raw",
+                "testbedyml=",
+                "os=",
+                "workers=",
+                "chunk-hours=",
+                "rate=",
+                "batch=",
+            ],
+        )
+    except getopt.GetoptError:
+        log.error(
+            "reprocess.py --start=<ms> --end=<ms> [--sink=file|tb]"
+            + " [--output=<file>] [--tbfile=<thingsboard.yml>]"
+            + " [--schema=flat|ports] [--raw] [--testbedyml=<testbedsyml>]"
+            + " [--os=<os>]"
+            + " [--workers=<processes>] [--chunk-hours=<hours>]"
+            + " [--rate=<requests/s>] [--batch=<points>]"
+        )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--start":
+            start = int(arg)
+        if opt == "--end":
+            end = int(arg)
+        if opt == "--sink":
+            SINK = arg
+        if opt == "--output":
+            OUTPUT_FILE = arg
+        if opt in ("-t", "--tbfile"):
+            tb_file = arg
+        if opt == "--schema":
+            SCHEMA = arg
+        if opt == "--raw":
+            RAW = True
+        if opt == "--testbedyml":
+            testbed_file = arg
+        if opt == "--os":
+            DEFAULT_OS = arg
+        if opt == "--workers":
+            WORKERS = int(arg)
+        if opt == "--chunk-hours":
+            CHUNK_MS = int(arg) * 3600 * 1000
+        if opt == "--rate":
+            RATE = float(arg)
+        if opt == "--batch":
+            BATCH = int(arg)
+
+    if SCHEMA not in power.SCHEMAS:
+        log.error("Unknown schema %s", SCHEMA)
+        sys.exit(2)
+    if SCHEMA == "compact":
+        log.error(
+            "Schema compact not supported: the ports order of past points is"
+            + " not archived, use flat or ports"
+        )
+        sys.exit(2)
+
+    # Load the OS of the switches from the testbed file
+    if RAW:
+        try:
+            testbed = loader.load(testbed_file)
+            device_oses = {str(name): d.os for name, d in testbed.devices.items()}
+        except pyats.utils.yaml.exceptions.LoadError as error:
+            log.warning(
+                "Failed to load testbed file, using OS %s: %s", DEFAULT_OS, error
+            )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    if SINK == "tb":
+        api = yaml.load(open(tb_file, encoding="utf-8"), Loader=yaml.Loader)["api"]
+        sink = TbSink(TbRestClient(api), RateLimiter(RATE), BATCH)
+    else:
+        sink = FileSink(OUTPUT_FILE)
+
+    outputs = OutputIndex(EXTRA_OUTPUT_DIR)
+    outputs.update()
+
+    # Chunks in time order, all switches of a chunk before the next one
+    jobs = [
+        (device, chunk_start, min(chunk_start + CHUNK_MS - 1, end))
+        for chunk_start in range(start, end + 1, CHUNK_MS)
+        for device in outputs.devices()
+    ]
+    log.info("Reprocessing %i chunks with %i workers", len(jobs), WORKERS)
+
+    records, points = 0, 0
+    reprocess_start = last_progress = time.perf_counter()
+    with Pool(
+        processes=WORKERS,
+        initializer=init_worker,
+        initargs=(RAW, device_oses, DEFAULT_OS),
+    ) as p:
+        # imap keeps the order of the jobs, the workers run ahead
+        for n, collection in p.imap(transform, jobs):
+            records += n
+            for c in power.encode_schema([collection], SCHEMA)[0]:
+                points += sink.write(c)
+            if time.perf_counter() - last_progress >= PROGRESS_S:
+                last_progress = time.perf_counter()
+                duration_s = last_progress - reprocess_start
+                log.info(
+                    "Reprocessed %i records, %.1f records/s",
+                    records,
+                    records / duration_s,
+                )
+    sink.close()
+    duration_s = time.perf_counter() - reprocess_start
+
+    log.info(
+        "Reprocessed %i records into %i points in %.1fs"
+        + " (%.1f records/s, %.1f points/s)",
+        records,
+        points,
+        duration_s,
+        records / duration_s if duration_s else 0,
+        points / duration_s if duration_s else 0,
+    )
+    if not records:
+        # Nothing archived the switch outputs over the range
+        log.error(
+            "No archived outputs of %s between %i and %i under %s, archived by"
+            + " streamer_collector, streamer_switches (--extra-store) and"
+            + " streamer_switches_extra",
+            ", ".join(power.ARCHIVED_COMMANDS.values()),
+            start,
+            end,
+            EXTRA_OUTPUT_DIR,
+        )
+        sys.exit(1)
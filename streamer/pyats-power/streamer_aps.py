@@ -21,6 +21,15 @@ Streams live data of APs to Thingsboard.
 APs are the ones read from:
     disk, under /streamer/pyats-power/output.that
 
+PoE details are read from the latest file per interface (--store=files,
+default) or from the segment store of each switch (--store=segments),
+matching the --store option of streamer_switches.
+
+With --watch (Linux, requires inotify_simple), new PoE details are
+published as soon as they are written, based on inotify events, instead
+of every ~11 minutes. A full
+rescan still runs every 10 minutes.
+
 Expects:
  - broker file            '/onboard/thingsboard.yml'
 
@@ -45,10 +54,12 @@ import multiprocessing
 import json
 import yaml
 
+from ..utils import cdp
 from ..utils import local
 from ..utils import mqttutils
 from ..utils.logger import log
-
+from ..utils.segments import SegmentStore, SEGMENTS_DIR, LATEST_FILE
+from ..utils.topology import Topology, TOPOLOGY_FILE
 
 # Thingsboard broker
 broker = []
@@ -56,76 +67,330 @@ broker = []
 # Set default paths
 broker_file = "/onboard/thingsboard.yml"
 ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+PUBLISHED_FILE = os.path.join(os.path.dirname(__file__), "state", "aps_published.json")
+RECYCLE_AFTER = 1000  # Tasks after which a reader process is replaced
+STORE = "files"  # Storage of the PoE details, as in streamer_switches
+WATCH = False  # Set to true to publish on filesystem notifications
+RESCAN_S = 600  # Full rescan period in watch mode
+PUBLISH_TIMEOUT_S = 120  # Wait for the acknowledgements of the broker
+CDP_DIR = "show_cdp_neighbors"
 
 
-def read_aps_power(switch):
+def changed(mtimes, path):
     """
-    Read PoE information from local disk for all APs of a given switch.
+    Compares the modification time of a path with the one in mtimes,
+    and updates it.
 
-    Returns: Thingsboard-MQTT formatted collection of sample points, e.g.:
-    [AP_1: {"ts": ts, "values": {"PoE": 6.5}}]
+    Returns: True if the path changed, False if not or if it does not exist.
     """
 
-    collection = []
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    if mtimes.get(path) == mtime:
+        return False
+    mtimes[path] = mtime
+    return True
+
+
+class CdpNeighbors:
+    """
+    A class that maps the APs to their switch ports, based on the topology
+    index maintained by the switch collectors (see utils/topology.py) or,
+    without index, on the CDP neighbors they saved.
 
-    # Get measured power for each CDP neighbor
-    # from the power inline <if> details file.
-    # Based on the latest file.
+    On refresh, the index is loaded again only if it changed, and only the
+    switches whose CDP directory changed are read again; the differences
+    are applied to the mapping.
+    """
 
-    # For each AP
-    for i, neighbor in enumerate(switch[1]):
-        # Only used only when patching missing data
+    def __init__(self, root):
+        self.root = root
+        self.switches = {}  # switch -> [(AP, local interface)]
+        self.aps = {}  # AP -> (switch, local interface)
+        self._mtimes = {}  # path -> mtime_ns
+
+    def items(self):
+        """Returns: [(switch, [(AP, local interface)])]."""
+
+        return list(self.switches.items())
+
+    def _read_cdp_files(self, p):
         """
-        if neighbor[0] in to_be_updated_TS:
-            collection.append({})
-            continue
-        else:
+        Reads the CDP neighbors saved since the last refresh, in the pool.
+        Returns: True if any were read.
         """
-        collection.append({neighbor[0]: []})
 
-        interface_dir = os.path.join(
-            ON_PREM_OUTPUT_DIR,
-            switch[0],
-            "show_power_inline_" + neighbor[1] + "_detail",
-        )
+        sources = []
+        for switch in os.listdir(self.root):
+            cdp_dir = os.path.join(self.root, switch, CDP_DIR)
+            if not changed(self._mtimes, cdp_dir):
+                continue
+            names = [f for f in os.listdir(cdp_dir) if f.isdigit()]
+            if names:
+                sources.append((switch, os.path.join(cdp_dir, max(names, key=int))))
+        if not sources:
+            return False
+
         try:
-            # file = os.path.join(interface_dir, os.listdir(interface_dir)[0])
-            with open(
-                os.path.join(interface_dir, os.listdir(interface_dir)[0]),
-                encoding="utf-8",
-            ) as fp:
-                # Initialize
+            for switch, neighbors in p.map(local.read_cdp_neigbors, sources):
+                self.switches[switch] = neighbors
+        except ValueError as e:
+            # File being written, read again at the next refresh
+            log.warning("Cannot read CDP neighbors: %s", e)
+            for switch, _ in sources:
+                self._mtimes.pop(os.path.join(self.root, switch, CDP_DIR), None)
+        return True
+
+    def refresh(self, p):
+        """Reads the topology index, or the CDP neighbors, if they changed."""
+
+        if os.path.exists(TOPOLOGY_FILE):
+            if not changed(self._mtimes, TOPOLOGY_FILE):
+                return
+            topology = Topology.load(TOPOLOGY_FILE)
+            self.switches = {s: topology.switch(s) for s in topology.switches}
+            log.info("Loaded topology generation %i", topology.generation)
+        elif not self._read_cdp_files(p):
+            return
+
+        aps = {
+            ap: (switch, interface)
+            for switch, neighbors in self.switches.items()
+            for ap, interface in neighbors
+        }
+        added, moved, removed = cdp.diff_neighbors(self.aps, aps)
+        for ap, port in moved.items():
+            log.info("AP %s moved from %s to %s", ap, self.aps[ap], port)
+        log.info(
+            "CDP neighbors: %i APs added, %i moved, %i removed",
+            len(added),
+            len(moved),
+            len(removed),
+        )
+        self.aps = aps
 
-                payload = json.load(fp)
-                ts = os.path.basename(
-                    os.path.join(interface_dir, os.listdir(interface_dir)[0])
-                )
 
-                measured_power = float(
-                    payload["interface"][neighbor[1]]["measured_consumption"]
+class LatestSamples:
+    """
+    A class that indexes the latest PoE details sample per (switch, interface),
+    and the timestamp of the last sample published per AP.
+
+    The index is built once, then refreshed incrementally: a details
+    directory (or the latest.json of a segment store) is read again only
+    if its modification time changed.
+
+    The last published timestamps are kept in state_file across restarts.
+    """
+
+    def __init__(self, root, store, state_file=None):
+        self.root = root
+        self.store = store
+        self.state_file = state_file
+        self.entries = {}  # (switch, interface) -> (ts, pointer)
+        self.published = {}  # AP -> ts
+        self.skipped = 0  # samples indexed again but already published, see log_skipped
+        self._updated = set()  # (switch, interface) indexed since the last new_samples
+        self._mtimes = {}  # path -> mtime_ns
+
+        if state_file and os.path.exists(state_file):
+            with open(state_file, encoding="utf-8") as fp:
+                self.published = json.load(fp)
+            log.info("Loaded the last published samples of %i APs", len(self.published))
+
+    def save(self):
+        """Writes the last published timestamps to the state file, atomically."""
+
+        if not self.state_file:
+            return
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(self.state_file + ".tmp", "w", encoding="utf-8") as fp:
+            json.dump(self.published, fp)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def _set(self, switch, interface, ts, pointer):
+        entry = self.entries.get((switch, interface))
+        if entry is None or int(ts) > int(entry[0]):
+            self.entries[(switch, interface)] = (ts, pointer)
+            self._updated.add((switch, interface))
+
+    def update_file(self, switch, interface, path):
+        """Indexes a details file, as reported by the watcher."""
+
+        if os.path.basename(path).isdigit():
+            self._set(switch, interface, os.path.basename(path), path)
+
+    def update_segments(self, switch):
+        """Indexes the latest records of the segment store of a switch."""
+
+        store = SegmentStore(os.path.join(self.root, switch))
+        for interface, pointer in store.latest_pointers().items():
+            self._set(switch, interface, pointer[0], pointer)
+
+    def refresh(self, cdp_neighbors):
+        """Indexes the samples written since the last refresh."""
+
+        for switch, neighbors in cdp_neighbors:
+            if self.store == "segments":
+                latest_file = os.path.join(self.root, switch, SEGMENTS_DIR, LATEST_FILE)
+                if changed(self._mtimes, latest_file):
+                    self.update_segments(switch)
+                continue
+
+            for _, interface in neighbors:
+                interface_dir = os.path.join(
+                    self.root, switch, "show_power_inline_" + interface + "_detail"
                 )
+                if not changed(self._mtimes, interface_dir):
+                    continue
+                try:
+                    names = [f for f in os.listdir(interface_dir) if f.isdigit()]
+                except FileNotFoundError:
+                    # Removed since its modification time was read
+                    self._mtimes.pop(interface_dir, None)
+                    continue
+                if names:
+                    ts = max(names, key=int)
+                    self._set(switch, interface, ts, os.path.join(interface_dir, ts))
+
+    def new_samples(self, cdp_neighbors):
+        """
+        Returns: jobs for read_sample, for the APs whose latest sample
+        is newer than the last one published.
+        """
 
-                data = {"ts": ts, "values": {"PoE": measured_power}}
-                collection[i].get(neighbor[0]).append(data)
-        except FileNotFoundError as e:
-            log.warning("Will skip reading data for {}".format(neighbor[0]))
+        jobs = []
+        for switch, neighbors in cdp_neighbors:
+            for ap, interface in neighbors:
+                entry = self.entries.get((switch, interface))
+                if entry is None:
+                    continue
+                ts, pointer = entry
+                if int(ts) > self.published.get(ap, -1):
+                    jobs.append((ap, switch, interface, int(ts), pointer))
+                elif (switch, interface) in self._updated:
+                    self.skipped += 1
+        self._updated.clear()
+        return jobs
+
+    def log_skipped(self):
+        """Logs the samples skipped as already published since the last call."""
+
+        if self.skipped:
+            log.info("Skipped %i samples already published", self.skipped)
+        self.skipped = 0
+
+    def mark_published(self, collection):
+        for item in collection:
+            for ap, data in item.items():
+                self.published[ap] = data[0]["ts"]
+        self.save()
+
+
+def read_sample(job):
+    """
+    Reads PoE information of an AP from local disk.
+    Expects: job = (AP, switch, interface, ts in ms, pointer), pointer being
+    the path of a details file or [ts, segment, offset] in a segment store
 
-    return collection
+    Returns: Thingsboard-MQTT formatted sample point, e.g.:
+    {AP_1: [{"ts": ts, "values": {"PoE": 6.5}}]}, {} if not readable
+    """
+
+    ap, switch, interface, ts, pointer = job
+    try:
+        if isinstance(pointer, list):
+            store = SegmentStore(os.path.join(ON_PREM_OUTPUT_DIR, switch))
+            sample = store.latest(interface, {interface: pointer})
+            if sample is None:
+                raise FileNotFoundError(interface)
+            payload = sample[1]
+        else:
+            with open(pointer, encoding="utf-8") as fp:
+                payload = json.load(fp)
+
+        measured_power = float(payload["interface"][interface]["measured_consumption"])
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        log.warning("Will skip reading data for {}".format(ap))
+        return {}
+
+    return {ap: [{"ts": ts, "values": {"PoE": measured_power}}]}
+
+
+def read_new_samples(p, samples, cdp_neighbors):
+    """Returns: collection of the samples not published yet, read in parallel."""
+
+    return [c for c in p.map(read_sample, samples.new_samples(cdp_neighbors)) if c]
+
+
+def watch(p, samples, cdp_neighbors, this_file):
+    """
+    Publishes the APs' PoE as soon as the switch collectors write it,
+    with a full rescan every RESCAN_S seconds as a safety net.
+    The CDP neighbors are refreshed at each rescan.
+    """
+
+    # inotify_simple is needed with --watch only
+    from ..utils.watcher import OutputWatcher
+
+    watcher = OutputWatcher(ON_PREM_OUTPUT_DIR)
+    mqtt_client = None
+    next_rescan = 0
+
+    while True:
+        if time.time() >= next_rescan:
+            # Full rescan, as in polling mode
+            samples.log_skipped()
+            watcher.add_tree()
+            cdp_neighbors.refresh(p)
+            samples.refresh(cdp_neighbors.items())
+            next_rescan = time.time() + RESCAN_S
+        else:
+            timeout_ms = int(max(next_rescan - time.time(), 0) * 1000)
+            for switch, interface, path in watcher.read(timeout_ms):
+                if interface is None:
+                    samples.update_segments(switch)
+                else:
+                    samples.update_file(switch, interface, path)
+
+        collection = read_new_samples(p, samples, cdp_neighbors.items())
+        if not collection:
+            continue
+
+        # Keep the MQTT client connected between events
+        if mqtt_client is None or not mqtt_client.is_connected():
+            mqtt_client = mqttutils.create_client(broker, this_file)
+        log.info("Publishing content for %i APs", len(collection))
+        # Only the samples acknowledged by the broker are marked as published,
+        # the others are published again with the next ones
+        samples.mark_published(
+            mqttutils.publish_collections_confirmed(
+                mqtt_client, collection, PUBLISH_TIMEOUT_S
+            )
+        )
 
 
 def main(argv):
     """Parses arguments and loads metadata."""
 
-    global broker, broker_file
+    global broker, broker_file, STORE, WATCH
 
     try:
-        opts, args = getopt.getopt(argv, "m:", ["brokerfile="])
+        opts, args = getopt.getopt(argv, "m:", ["brokerfile=", "store=", "watch"])
     except getopt.GetoptError:
-        log.error("streamer_aps.py --brokerfile=<new_thingsboard.yml>")
+        log.error(
+            "streamer_aps.py --brokerfile=<new_thingsboard.yml> [--store=files|segments]"
+            + " [--watch]"
+        )
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("-m", "--brokerfile"):
             broker_file = arg
+        if opt == "--store":
+            STORE = arg
+        if opt == "--watch":
+            WATCH = True
 
     log.info("§§§ On-prem reading. §§§")
 
@@ -140,60 +405,46 @@ if __name__ == "__main__":
 
     this_file = os.path.basename(__file__)
 
-    # Read from local disk
-    # Read switches
-    switches = os.listdir(ON_PREM_OUTPUT_DIR)
-
-    # Read CDP neighbors
-    with multiprocessing.Pool(processes=8) as p:
-        cdp_neighbors = p.map(
-            local.read_cdp_neigbors,
-            [
-                (
-                    s,
-                    max(
-                        [
-                            os.path.join(ON_PREM_OUTPUT_DIR, s, "show_cdp_neighbors", f)
-                            for f in os.listdir(
-                                os.path.join(
-                                    ON_PREM_OUTPUT_DIR, s, "show_cdp_neighbors"
-                                )
-                            )
-                        ],
-                        key=os.path.getctime,
-                    ),
-                )
-                for s in switches
-            ],
-        )
+    # Readers live for the whole run,
+    # recycled after RECYCLE_AFTER tasks to limit memory growth
+    p = multiprocessing.Pool(processes=8, maxtasksperchild=RECYCLE_AFTER)
 
-    log.info("CDP Neighbors - %s", str(cdp_neighbors))
+    # Read CDP neighbors, refreshed every cycle
+    cdp_neighbors = CdpNeighbors(ON_PREM_OUTPUT_DIR)
+    cdp_neighbors.refresh(p)
+    log.info("CDP Neighbors - %s", str(cdp_neighbors.items()))
 
-    # Read latest AP data, every ~13 minutes
-    while True:
-        # Read APs power based on show power inline <interface> detail CLI command
-        with multiprocessing.Pool(processes=8) as p:
-            collections = p.map(read_aps_power, cdp_neighbors)
+    # Index of the latest samples, built once and refreshed every cycle
+    samples = LatestSamples(ON_PREM_OUTPUT_DIR, STORE, PUBLISHED_FILE)
 
-        # Connect to Thingsboard's MQTT broker and send APs' data
-        mqtt_client = mqttutils.create_client(broker, this_file)
+    if WATCH:
+        watch(p, samples, cdp_neighbors, this_file)
 
-        flatten_collections = [
-            item for collection in collections for item in collection
-        ]
+    # Read latest AP data, every ~13 minutes
+    while True:
+        # Read APs power based on show power inline <interface> detail CLI command,
+        # only the samples written since the last cycle
+        cdp_neighbors.refresh(p)
+        samples.refresh(cdp_neighbors.items())
+        flatten_collections = read_new_samples(p, samples, cdp_neighbors.items())
+        samples.log_skipped()
         log.info("Publishing content for %i APs", len(flatten_collections))
 
-        # Publish every ~11 minutes but give MQTT client
-        # 120s time to post messages before disconnecting
-        msg_info = mqttutils.publish_collections_telemetry(
-            mqtt_client, flatten_collections, sleep_once_s=120
-        )
-
-        try:
-            log.info(msg_info.is_published())
-        except Exception as e:
-            log.error("ERROR on telemetry publish: %s", str(e))
-        mqtt_client.disconnect()
+        if flatten_collections:
+            # Connect to Thingsboard's MQTT broker and send APs' data
+            mqtt_client = mqttutils.create_client(broker, this_file)
+
+            # Publish every ~11 minutes but give MQTT client
+            # 120s time to post messages before disconnecting;
+            # only the samples acknowledged are marked as published
+            publish_start = time.time()
+            samples.mark_published(
+                mqttutils.publish_collections_confirmed(
+                    mqtt_client, flatten_collections, PUBLISH_TIMEOUT_S
+                )
+            )
+            time.sleep(max(PUBLISH_TIMEOUT_S - (time.time() - publish_start), 0))
+            mqtt_client.disconnect()
 
         # Wait another 9 minutes before querying again
         # (data is spaced at ~13 minutes)
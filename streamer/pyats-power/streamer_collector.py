@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Single collector for switches, replacing streamer_switches and
+streamer_switches_extra when run on its own.
+
+Each command has its own cadence (see CADENCES). Every tick, the commands
+that are due run over one SSH session per switch, kept open between ticks.
+Each command is executed once and parsed from its captured output,
+in a process pool separate from the I/O threads.
+
+The PoE details ("show power inline <interface> detail") run every minute
+only for the ports of the APs (CDP neighbors), whose measured power
+"show power inline" does not report, and for the ports whose state or
+allocated power changed in "show power inline"; every hour, they run for
+all ports. A tick thus fits in a minute on stacks.
+
+Results go to:
+- Thingsboard MQTT broker (switch telemetry, as streamer_switches)
+- disk, under /streamer/pyats-power/output
+  (PoE details and CDP neighbors, as streamer_switches, read by streamer_aps)
+- disk, under /streamer/pyats-power/extra-output
+  (CLI and JSON outputs of every command, as streamer_switches_extra)
+- disk, under /streamer/pyats-power/timings
+  (timings of each phase, per device and command, see utils/timing.py).
+
+With --schema=ports or --schema=compact, the per-port values are published
+as child port devices or as arrays, and the powered devices as attributes
+(see utils/power.py).
+
+With --store=segments, PoE details are appended to a segment store per
+switch instead of the latest file per interface (see utils/segments.py).
+
+With --extra-store=archive, the other outputs are stored once per distinct
+content, compressed, with a manifest of time pointers per switch (see
+utils/archive.py), compacted daily to --retention-days (default 90).
+
+With --publish-aps, the PoE details are also mapped to the APs of the CDP
+neighbors and published as APs' telemetry in the same tick; the files are
+still written, but streamer_aps is then not needed.
+
+This script runs only on real devices.
+
+Expects:
+- broker file            /onboard/thingsboard.yml
+- switches file          /onboard/testbed.yml
+
+Run example:
+  cd <main folder>
+  pip3 install -r streamer/pyats-power/requirements.txt
+
+  python3.9 -m streamer.pyats-power.streamer_collector \
+    --brokerfile=onboard/thingsboard.yml --testbedyml=onboard/testbed.yml [--dry-run]
+
+Run example as a service:
+  cd <main folder>
+  docker-compose up -d streamer-collector
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import yaml
+import unicon
+from pyats.topology import loader
+import pyats.utils.yaml.exceptions
+
+from ..utils import cdp
+from ..utils import power
+from ..utils import parsing
+from ..utils import mqttutils
+from ..utils.logger import log
+from ..utils.timing import Timings
+from ..utils.breaker import FleetBreaker
+from ..utils.topology import Topology
+from ..utils.archive import ArchiveStore
+from ..utils.segments import SegmentStore
+
+# Set default paths
+testbed_file = "/onboard/testbed.yml"
+broker_file = "/onboard/thingsboard.yml"
+
+DRY_RUN = False  # Set to true for data display
+PUBLISH_TIMINGS = False  # Set to true to publish timings as "streamer" telemetry
+SCHEMA = "flat"  # Telemetry schema of the per-port values, see utils/power.py
+STORE = "files"  # Storage of the PoE details: files or segments
+EXTRA_STORE = "files"  # Storage of the other outputs: files or archive
+RETENTION_DAYS = 90  # Retention of the archive
+COMPACT_EVERY_S = 24 * 3600  # Period of the compaction of the archive
+PUBLISH_APS = False  # Set to true to publish APs' PoE telemetry in the same tick
+ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+TIMINGS_DIR = os.path.join(os.path.dirname(__file__), "timings")
+
+IO_WORKERS = 32  # Threads holding the device sessions
+PARSE_WORKERS = os.cpu_count()  # Processes parsing CLI outputs
+RECYCLE_AFTER = 1000  # Tasks after which a parser process is replaced
+TICK_S = 60  # Smallest cadence
+DETAIL_COMMAND = "show power inline %s detail"
+DETAIL_REFRESH_S = 3600  # Details of all ports; in between, of AP and changed ports
+
+# Cadence in seconds of each command, in order of execution.
+# "show power inline" must run before its detail command, which runs only
+# for the ports of the APs and the ports whose state or power changed, and
+# every DETAIL_REFRESH_S for all ports.
+CADENCES = {
+    "show power inline": 60,
+    DETAIL_COMMAND: 60,
+    "show env all": 300,
+    "show cdp neighbors": 3600,
+    "show version": 3600,
+    "show power total": 3600,
+    "show environment": 3600,
+    "show environment all": 3600,
+    "show environment power all": 3600,
+    "show power status all": 3600,
+    "show power available": 3600,
+    "show power used": 3600,
+    "show int status": 3600,
+}
+
+last_run = {}  # (device, command) -> time of last run
+ports = {}  # device -> {interface: (state, power)} of the latest "show power inline"
+changed_ports = {}  # device -> interfaces changed by the latest "show power inline"
+details_refreshed = {}  # device -> time of the last details of all ports
+cdp_neighbors = {}  # device -> [(AP name, local interface)]
+
+
+def save(directory, name, content):
+    """Saves content to a file in directory, created if missing."""
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as output_file:
+        output_file.write(content)
+
+
+def due_commands(device, now):
+    """
+    Lists the commands of a device whose cadence has elapsed.
+
+    Returns: commands.
+    """
+
+    # Allow a few seconds of jitter on the tick
+    return [
+        command
+        for command, cadence in CADENCES.items()
+        if now - last_run.get((device, command), 0) >= cadence - 5
+    ]
+
+
+def run_command(d, command):
+    """
+    Executes a command once and parses its captured output in the parser pool.
+
+    Returns: (cli output, parsed output or None if no parser exists).
+    """
+
+    with timings.phase(d.name, "execute", command):
+        cli_format_out = d.execute(command)
+    json_format_out, duration_s = parse_pool.apply(
+        parsing.parse_output_timed, ((d.os, command, cli_format_out),)
+    )
+    timings.add(d.name, "parse", duration_s, command)
+    return cli_format_out, json_format_out
+
+
+def archive(device, command, timestamp, cli_format_out, json_format_out):
+    """Saves the outputs of a command to the on-disk archive."""
+
+    if DRY_RUN:
+        return
+    command_dir = "_".join(command.split(" "))
+
+    # PoE details and CDP neighbors are read by streamer_aps
+    if command == "show cdp neighbors" and not json_format_out:
+        # Keep the previous neighbors
+        log.warning("No CDP neighbors parsed for %s, keeping the previous", device)
+        return
+    if command.endswith(" detail") or command == "show cdp neighbors":
+        output_dir = os.path.join(ON_PREM_OUTPUT_DIR, device, command_dir)
+        save(output_dir, timestamp, json.dumps(json_format_out))
+        if command.endswith(" detail"):
+            # streamer_aps expects a single, latest file per interface
+            for old in os.listdir(output_dir):
+                if old != timestamp:
+                    os.remove(os.path.join(output_dir, old))
+        return
+
+    if EXTRA_STORE == "archive":
+        archive_store.put(device, timestamp, command, "cli", cli_format_out)
+        if json_format_out is not None:
+            archive_store.put(
+                device,
+                timestamp,
+                command,
+                "json",
+                json.dumps(json_format_out, indent=2),
+            )
+        return
+
+    device_dir = os.path.join(EXTRA_OUTPUT_DIR, device, command_dir)
+    save(device_dir, timestamp + ".cli", cli_format_out)
+    if json_format_out is not None:
+        save(device_dir, timestamp + ".json", json.dumps(json_format_out, indent=2))
+
+
+def connect_collect(device):
+    """
+    Runs the due commands of a switch over its shared session
+    and saves their outputs on the local disk.
+    Returns: data, empty if the switch is unreachable, None if nothing is due.
+    """
+
+    output_data = {}
+    d = testbed.devices[device]
+    now = time.time()
+    commands = due_commands(device, now)
+    if not commands:
+        return None
+
+    try:
+        if not d.is_connected():
+            log.info("Device testbed: {}".format(d))
+            with timings.phase(device, "connect"):
+                d.connect(
+                    learn_hostname=True, log_stdout=False, init_config_commands=[]
+                )
+        output_data["date"] = int(time.time_ns() / 1000000)
+        output_data["device"] = str(device)
+        timestamp = str(output_data["date"])
+
+        for command in commands:
+            if command == DETAIL_COMMAND:
+                refresh = now - details_refreshed.get(device, 0) >= DETAIL_REFRESH_S - 5
+                if refresh:
+                    detail_ports = list(ports.get(device, {}))
+                else:
+                    # "show power inline" shows the allocated power: the
+                    # measured power of the APs is read every tick
+                    detail_ports = list(changed_ports.get(device, []))
+                    for _, intf in cdp_neighbors.get(device, []):
+                        if intf not in detail_ports:
+                            detail_ports.append(intf)
+                composite_commands = [command % i for i in detail_ports]
+            else:
+                composite_commands = [command]
+
+            details = []  # Records for the segment store
+            for composite_command in composite_commands:
+                try:
+                    cli_format_out, json_format_out = run_command(d, composite_command)
+                except unicon.core.errors.SubCommandFailure as e:
+                    log.warning(
+                        "{}: Exception on [running] command {}: {}".format(
+                            device, composite_command, e
+                        )
+                    )
+                    continue
+                output_data[composite_command] = json_format_out
+                if command == DETAIL_COMMAND and STORE == "segments":
+                    details.append(
+                        (composite_command.split(" ")[3], timestamp, json_format_out)
+                    )
+                    continue
+                with timings.phase(device, "write", composite_command):
+                    archive(
+                        device,
+                        composite_command,
+                        timestamp,
+                        cli_format_out,
+                        json_format_out,
+                    )
+
+            # Save the PoE details in one batch
+            if details and not DRY_RUN:
+                with timings.phase(device, "write", command):
+                    SegmentStore(os.path.join(ON_PREM_OUTPUT_DIR, device)).append(
+                        details
+                    )
+
+            if command == "show power inline" and output_data.get(command):
+                # retain the interfaces, and those whose state or power changed
+                current = {
+                    intf: (values.get("oper_state"), values.get("power"))
+                    for intf, values in output_data[command]["interface"].items()
+                }
+                previous = ports.get(device, {})
+                changed_ports[device] = [
+                    intf for intf in current if previous.get(intf) != current[intf]
+                ]
+                ports[device] = current
+            if command == DETAIL_COMMAND and refresh:
+                details_refreshed[device] = now
+            last_run[(device, command)] = now
+
+    except unicon.core.errors.ConnectionError:
+        log.warning("Cannot connect to device {}".format(device))
+    except Exception:
+        # Drop the session, it is reopened on the next tick
+        log.error(traceback.format_exc())
+        try:
+            d.disconnect()
+        except Exception:
+            pass
+    return output_data
+
+
+def collect(device):
+    """
+    Collects the due CLI data of a switch.
+    Returns: (success, telemetry).
+    """
+
+    payload = connect_collect(device)
+    if payload is None:
+        return (True, {})
+    if not payload:
+        return (False, {})
+
+    try:
+        json_body = power.switch_telemetry(payload)
+
+        if payload.get("show cdp neighbors"):
+            # retain the APs of the CDP neighbors
+            cdp_neighbors[device] = cdp.get_cdp_neighbors(payload["show cdp neighbors"])
+            if topology.update_switch(device, cdp_neighbors[device]):
+                topology.save()
+        if PUBLISH_APS:
+            json_body.update(power.ap_telemetry(payload, cdp_neighbors.get(device, [])))
+        return (True, json_body)
+    except Exception:
+        log.error(traceback.format_exc())
+        log.error("Error on device : {}".format(device))
+    return (True, {})
+
+
+def main(argv):
+    """Parses arguments and loads metadata."""
+
+    global broker, broker_file, testbed, testbed_file, DRY_RUN, PUBLISH_TIMINGS
+    global SCHEMA, STORE, PUBLISH_APS, EXTRA_STORE, RETENTION_DAYS
+    global IO_WORKERS, PARSE_WORKERS, RECYCLE_AFTER
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "mtd",
+            [
+                "brokerfile=",
+                "testbedyml=",
+                "dry-run",
+                "io-workers=",
+                "parse-workers=",
+                "recycle-after=",
+                "publish-timings",
+                "schema=",
+                "store=",
+                "publish-aps",
+                "extra-store=",
+                "retention-days=",
+            ],
+        )
+    except getopt.GetoptError:
+        log.error(
+            "streamer_collector.py --brokerfile=<mqttbrokerfileyml> --testbedyml=<testbedsyml>"
+            + " [--io-workers=<threads>] [--parse-workers=<processes>]"
+            + " [--recycle-after=<tasks>] [--publish-timings]"
+            + " [--schema=flat|ports|compact]"
+            + " [--store=files|segments] [--publish-aps]"
+            + " [--extra-store=files|archive] [--retention-days=<days>]"
+        )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-m", "--brokerfile"):
+            broker_file = arg
+        if opt in ("-t", "--testbedyml"):
+            testbed_file = arg
+        if opt in ("-d", "--dry-run"):
+            DRY_RUN = True
+        if opt == "--io-workers":
+            IO_WORKERS = int(arg)
+        if opt == "--parse-workers":
+            PARSE_WORKERS = int(arg)
+        if opt == "--recycle-after":
+            RECYCLE_AFTER = int(arg)
+        if opt == "--publish-timings":
+            PUBLISH_TIMINGS = True
+        if opt == "--schema":
+            if arg not in power.SCHEMAS:
+                log.error("Unknown schema %s, expected one of %s", arg, power.SCHEMAS)
+                sys.exit(2)
+            SCHEMA = arg
+        if opt == "--store":
+            STORE = arg
+        if opt == "--publish-aps":
+            PUBLISH_APS = True
+        if opt == "--extra-store":
+            EXTRA_STORE = arg
+        if opt == "--retention-days":
+            RETENTION_DAYS = int(arg)
+
+    log.info("§§§ On-prem collection with per-command cadences. §§§")
+    os.makedirs(ON_PREM_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(EXTRA_OUTPUT_DIR, exist_ok=True)
+
+    # Load Thingsboard's MQTT broker information
+    broker = yaml.load(open(broker_file, encoding="utf-8"), Loader=yaml.Loader)[
+        "broker"
+    ]
+
+    # Load the switches testbed file
+    try:
+        testbed = loader.load(testbed_file)
+    except pyats.utils.yaml.exceptions.LoadError as error:
+        log.error("Failed to load testbed file: %s", str(error))
+        sys.exit(1)
+
+
+# Collect data from switches on every tick, save data on the disk
+# and to the Thingsboard's MQTT broker (to Thingsboard: all except APs data).
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+    this_file = os.path.basename(__file__)
+
+    # Skip unreachable switches instead of waiting for the connection timeout
+    breakers = FleetBreaker()
+    client = None
+
+    # Index of the APs' switch ports, read by streamer_aps, onboarding and exporter
+    topology = Topology.load()
+
+    # Deduplicated, compressed archive of the other outputs
+    archive_store = ArchiveStore(EXTRA_OUTPUT_DIR)
+    last_compaction = 0
+
+    # Per-device, per-phase timings, saved under TIMINGS_DIR every tick
+    timings = Timings()
+
+    # Attributes of the compact schemas, published only when they change
+    published_attributes = {}
+
+    # Threads share the sessions kept in the testbed's device objects,
+    # parsing runs in a process pool sized to the cores
+    parse_pool = Pool(
+        processes=PARSE_WORKERS,
+        initializer=parsing.init_worker,
+        initargs=({d.os for d in testbed.devices.values()}, list(CADENCES)),
+        maxtasksperchild=RECYCLE_AFTER,
+    )
+    with ThreadPool(processes=IO_WORKERS) as p:
+        while True:
+            tick_start = time.time()
+            devices = breakers.allowed(list(testbed.devices))
+            results = p.map(collect, devices)
+
+            for device, result in zip(devices, results):
+                breakers.record(device, result[0])
+            breakers.log_summary()
+            collections = [result[1] for result in results if result[1]]
+
+            # Re-encode the per-port values, static strings become attributes
+            attributes = {}
+            if SCHEMA != "flat":
+                flat_size = power.payload_size(collections)
+                collections, attributes = power.encode_schema(collections, SCHEMA)
+                log.info(
+                    "Payload size: %i bytes with schema %s, %i bytes with schema flat",
+                    power.payload_size(collections),
+                    SCHEMA,
+                    flat_size,
+                )
+                attributes = {
+                    device: a
+                    for device, a in attributes.items()
+                    if published_attributes.get(device) != a
+                }
+
+            if DRY_RUN:
+                for c in collections:
+                    print(json.dumps(c))
+            elif collections:
+                # Keep the MQTT client connected between ticks
+                if client is None or not client.is_connected():
+                    client = mqttutils.create_client(broker, this_file)
+                log.info("Finished gathering data.")
+                with timings.phase("streamer", "publish"):
+                    mqttutils.publish_collections_telemetry(
+                        client, collections, sleep_once_s=0
+                    )
+                if attributes:
+                    mqttutils.publish_attributes(client, attributes)
+                    published_attributes.update(attributes)
+                if PUBLISH_TIMINGS:
+                    mqttutils.publish_collections_telemetry(
+                        client, [timings.telemetry()], sleep_once_s=0
+                    )
+            timings.write(TIMINGS_DIR)
+
+            # Keep the archive within its retention
+            if (
+                EXTRA_STORE == "archive"
+                and not DRY_RUN
+                and time.time() - last_compaction >= COMPACT_EVERY_S
+            ):
+                archive_store.compact(int(time.time_ns() / 1000000), RETENTION_DAYS)
+                last_compaction = time.time()
+
+            time.sleep(max(TICK_S - (time.time() - tick_start), 0))
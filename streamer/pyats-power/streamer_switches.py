@@ -20,6 +20,34 @@ Streams data of switches to Thingsboard MQTT broker.
 
 Additionally,
     saves CDP neighbors on disk, under /streamer/pyats-power/output.
+    They are refreshed hourly and saved again only when the APs changed,
+    along with the topology index of the APs (see utils/topology.py).
+
+Device sessions are handled by many I/O threads (--io-workers), while the
+genie/ttp parsing of their raw outputs runs in a process pool sized to
+the cores (--parse-workers).
+
+Timings of each phase (connect, execute, parse, write, publish) are saved
+under /streamer/pyats-power/timings, per device and command. With
+--publish-timings, they are also published as telemetry of device "streamer".
+
+With --schema=ports or --schema=compact, the per-port values are published
+as child port devices or as arrays, and the powered devices as attributes
+(see utils/power.py).
+
+PoE details are saved as the latest file per interface (--store=files,
+default) or appended to a segment store per switch that retains
+history (--store=segments, see utils/segments.py).
+
+The outputs of "show env all" and "show power inline" are also archived
+under /streamer/pyats-power/extra-output, as files (--extra-store=files,
+default) or in the archive (--extra-store=archive, see utils/archive.py,
+compacted daily to --retention-days), for backfill.py and reprocess.py;
+--extra-store=none disables it.
+
+With --publish-aps, the PoE details are also mapped to the APs of the CDP
+neighbors and published as APs' telemetry in the same cycle; the files are
+still written, but streamer_aps is then not needed.
 
 This script runs only on real devices.
 
@@ -46,7 +74,6 @@ import os
 import sys
 import json
 import time
-import shutil
 import getopt
 import traceback
 from multiprocessing import Pool
@@ -54,266 +81,302 @@ from multiprocessing.pool import ThreadPool
 
 import yaml
 import unicon
-from ttp import ttp
 from pyats.topology import loader
 import pyats.utils.yaml.exceptions
-from genie.libs.parser.utils.common import ParserNotFound
-from genie.metaparser.util.exceptions import SchemaEmptyParserError
 
+from ..utils import cdp
+from ..utils import power
+from ..utils import parsing
 from ..utils import mqttutils
 from ..utils.logger import log
+from ..utils.timing import Timings
+from ..utils.breaker import FleetBreaker
+from ..utils.topology import Topology
+from ..utils.segments import SegmentStore
+from ..utils.archive import ArchiveStore
 
 # Set default paths
 testbed_file = "/onboard/testbed.yml"
 broker_file = "/onboard/thingsboard.yml"
 
 DRY_RUN = False  # Set to true for data display
-CDP_SAMPLED_ONCE = False  # Set to true once we take a first sample of CDP neighbors
+PUBLISH_TIMINGS = False  # Set to true to publish timings as "streamer" telemetry
+SCHEMA = "flat"  # Telemetry schema of the per-port values, see utils/power.py
+STORE = "files"  # Storage of the PoE details: files or segments
+EXTRA_STORE = "files"  # Storage of the archived outputs: files, archive or none
+RETENTION_DAYS = 90  # Retention of the archive
+COMPACT_EVERY_S = 24 * 3600  # Period of the compaction of the archive
+PUBLISH_APS = False  # Set to true to publish APs' PoE telemetry in the same cycle
+CDP_REFRESH_S = 3600  # Period of the CDP neighbors refresh
+cdp_sampled = {}  # switch -> time of the last CDP neighbors sample
 ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+EXTRA_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
+cdp_neighbors = {}  # switch -> [(AP name, local interface)]
+TIMINGS_DIR = os.path.join(os.path.dirname(__file__), "timings")
+IO_WORKERS = 32  # Threads waiting on device sessions
+PARSE_WORKERS = os.cpu_count()  # Processes parsing CLI outputs
+RECYCLE_AFTER = 1000  # Tasks after which a parser process is replaced
+
+COMMANDS = [
+    "show env all",
+    "show power inline",  # Must be at index 1
+    "show power inline %s detail",  # Must be at index 2
+    "show version",
+    "show cdp neighbors",  # Must be at index 4
+    # "show energywise",
+    # "show env temperature status"
+]
+
+
+def submit(d, command, raws):
+    """
+    Runs a command on the switch and hands its raw output over to the parser pool.
+    The raw outputs of the archived commands are kept in raws.
+    Returns: async result of the parsing.
+    """
+
+    with timings.phase(d.name, "execute", command):
+        raw = d.execute(command)
+    if command in power.ARCHIVED_COMMANDS:
+        raws[command] = raw
+    return parse_pool.apply_async(parsing.parse_output_timed, ((d.os, command, raw),))
+
+
+def wait(device, command, result):
+    """
+    Waits for the parsing of the output of a command.
+    Returns: parsed output, None if no parser exists.
+    """
+
+    try:
+        out, duration_s = result.get()
+        timings.add(device, "parse", duration_s, command)
+    except Exception as e:
+        log.error(
+            "{} Failed to parse output of command {}: {}".format(device, command, e)
+        )
+        out = {}
+    return out
+
+
+def save_output(device, command, date, data):
+    """Saves the output of a command on the local disk."""
+
+    # Create command directory
+    command_dir = os.path.join(ON_PREM_OUTPUT_DIR, device, "_".join(command.split(" ")))
+    os.makedirs(command_dir, exist_ok=True)
+
+    # Save file in directory
+    with open(
+        os.path.join(command_dir, str(date)), "w", encoding="utf-8"
+    ) as output_file:
+        output_file.write(json.dumps(data))
+
+    if command.endswith(" detail"):
+        # Remove old content, keep only the latest file
+        for f in os.listdir(command_dir):
+            if f != str(date):
+                os.remove(os.path.join(command_dir, f))
+
+
+def archive_output(device, command, date, raw, out):
+    """
+    Saves the raw and parsed outputs of a command to the on-disk archive,
+    in the layout of streamer_collector, read by backfill.py and reprocess.py.
+    """
+
+    if EXTRA_STORE == "none" or DRY_RUN:
+        return
+    timestamp = str(date)
+    if EXTRA_STORE == "archive":
+        archive_store.put(device, timestamp, command, "cli", raw)
+        if out is not None:
+            archive_store.put(
+                device, timestamp, command, "json", json.dumps(out, indent=2)
+            )
+        return
+
+    command_dir = os.path.join(EXTRA_OUTPUT_DIR, device, "_".join(command.split(" ")))
+    os.makedirs(command_dir, exist_ok=True)
+    with open(
+        os.path.join(command_dir, timestamp + ".cli"), "w", encoding="utf-8"
+    ) as output_file:
+        output_file.write(raw)
+    if out is not None:
+        with open(
+            os.path.join(command_dir, timestamp + ".json"), "w", encoding="utf-8"
+        ) as output_file:
+            output_file.write(json.dumps(out, indent=2))
+
+
+def refresh_cdp(device, date, data):
+    """
+    Retains the APs of the CDP neighbors of a switch, and saves the
+    CDP neighbors on the local disk only if the APs changed, so that
+    streamer_aps applies the changes. An output that failed to parse
+    keeps the previous neighbors, and is sampled again at the next cycle.
+    """
+
+    if not data:
+        log.warning("No CDP neighbors parsed for %s, keeping the previous", device)
+        return
+    cdp_sampled[device] = time.time()
+    neighbors = cdp.get_cdp_neighbors(data)
+    if device in cdp_neighbors and neighbors == cdp_neighbors[device]:
+        return
+
+    added, moved, removed = cdp.diff_neighbors(
+        {ap: (device, intf) for ap, intf in cdp_neighbors.get(device, [])},
+        {ap: (device, intf) for ap, intf in neighbors},
+    )
+    log.info(
+        "CDP neighbors of %s: %i APs added, %i moved, %i removed",
+        device,
+        len(added),
+        len(moved),
+        len(removed),
+    )
+    cdp_neighbors[device] = neighbors
+    with timings.phase(device, "write", "show cdp neighbors"):
+        save_output(device, "show cdp neighbors", date, data)
+        if topology.update_switch(device, neighbors):
+            topology.save()
 
 
 def connect_collect(device, commands):
     """
     Connects to switch, collects CLI data and saves it on the local disk.
-    Returns: data.
+    Runs in an I/O thread; the parsing happens in the parser pool.
+    Returns: (reachable, data).
     """
 
+    reachable = True
     output_data = {}
-    interfaces = []
+    results = {}
+    raws = {}  # Raw outputs of the archived commands
+    details = []  # Records for the segment store
     d = testbed.devices[device]
 
     try:
         log.info("Device testbed: {}".format(d))
-        d.connect(learn_hostname=True, log_stdout=False, init_config_commands=[])
+        with timings.phase(device, "connect"):
+            d.connect(learn_hostname=True, log_stdout=False, init_config_commands=[])
         output_data["date"] = int(time.time_ns() / 1000000)
         output_data["device"] = str(device)
         for idx, command in enumerate(commands):
-            try:
-                if idx == 2:  # show power inline %s detail
-                    # traverse interfaces and run command for each
-                    for i in interfaces:
-                        composite_command = command % (i)
-                        try:
-                            out = d.parse(composite_command)
-                            output_data[composite_command] = out
-                        except SchemaEmptyParserError as e:
-                            log.error(
-                                "{} Failed to parse output of composite command {}: {}".format(
-                                    str(d), composite_command, e
-                                )
-                            )
-                            output_data[composite_command] = {}
-
-                        # Save locally: command for power inline <interface> detail
-
-                        # Create device directory
-                        device_dir = os.path.join(ON_PREM_OUTPUT_DIR, device)
-                        os.makedirs(device_dir, exist_ok=True)
-
-                        interface_dir = os.path.join(
-                            device_dir, "_".join(composite_command.split(" "))
-                        )
-
-                        # Remove old content
-                        try:
-                            shutil.rmtree(interface_dir)
-                        except FileNotFoundError:
-                            pass
-                        try:
-                            os.makedirs(interface_dir)
-                        except FileExistsError:
-                            pass
-
-                        # Save file in directory
-                        with open(
-                            os.path.join(
-                                interface_dir,
-                                str(output_data["date"]),
-                            ),
-                            "w",
-                            encoding="utf-8",
-                        ) as output_file:
-                            output_file.write(
-                                json.dumps(output_data[composite_command])
-                            )
-
-                else:
-                    if idx != 4 or not CDP_SAMPLED_ONCE:
-                        try:
-                            output_data[command] = d.parse(command)
-                        except SchemaEmptyParserError as e:
-                            log.error(
-                                "{} Failed to parse output of command {}: {}".format(
-                                    str(d), command, e
-                                )
-                            )
-                            output_data[command] = {}
-                    if idx == 1 and output_data[command]:  # show power inline
-                        # retain the interface names
-                        interfaces = output_data[command]["interface"].keys()
-
-            except ParserNotFound:
-                if command == "show energywise":
-                    data = d.execute(command)
-                    ttp_template = (
-                        """Total: {{ total_usage }} (W), Count: {{ count }}"""
+            if idx == 2:  # show power inline %s detail
+                # retain the interface names of show power inline
+                output_data[commands[1]] = wait(
+                    device, commands[1], results.pop(commands[1])
+                )
+                with timings.phase(device, "write", commands[1]):
+                    archive_output(
+                        device,
+                        commands[1],
+                        output_data["date"],
+                        raws[commands[1]],
+                        output_data[commands[1]],
                     )
-                    parser = ttp(data=data, template=ttp_template)
-                    parser.parse()
-                    out = float(parser.result()[0][0]["total_usage"])
-                    output_data[command] = out
-                else:
-                    log.warning('No parser found for command : "{}"'.format(command))
-
-            finally:
-                if idx != 2:
-                    # Save locally only once: command for CDP neighbors
-                    if not CDP_SAMPLED_ONCE and idx == 4:
-                        # Create device directory
-                        device_dir = os.path.join(
-                            ON_PREM_OUTPUT_DIR, device, "show_cdp_neighbors"
-                        )
-                        os.makedirs(device_dir, exist_ok=True)
-
-                        # Save file in directory
-                        with open(
-                            os.path.join(device_dir, str(output_data["date"])),
-                            "w",
-                            encoding="utf-8",
-                        ) as output_file:
-                            output_file.write(json.dumps(output_data[command]))
+                interfaces = []
+                if output_data[commands[1]]:
+                    interfaces = output_data[commands[1]]["interface"].keys()
+
+                # traverse interfaces and run command for each
+                for i in interfaces:
+                    composite_command = command % (i)
+                    results[composite_command] = submit(d, composite_command, raws)
+            elif idx != 4 or time.time() - cdp_sampled.get(device, 0) >= CDP_REFRESH_S:
+                results[command] = submit(d, command, raws)
 
         d.disconnect()
     except unicon.core.errors.ConnectionError:
         log.warning("Cannot connect to device {}".format(device))
-    return output_data
+        reachable = False
+
+    # Wait for the parser pool
+    for command, result in results.items():
+        out = wait(device, command, result)
+        if out is not None:
+            output_data[command] = out
+
+        # Save locally: command for power inline <interface> detail
+        # and, when the APs changed, command for CDP neighbors
+        if command.endswith(" detail") and STORE == "segments":
+            details.append((command.split(" ")[3], output_data["date"], out or {}))
+        elif command.endswith(" detail"):
+            with timings.phase(device, "write", command):
+                save_output(device, command, output_data["date"], out or {})
+        elif command == commands[4]:
+            refresh_cdp(device, output_data["date"], out)
+        elif command in raws:
+            with timings.phase(device, "write", command):
+                archive_output(device, command, output_data["date"], raws[command], out)
+
+    # Save locally in one batch: commands for power inline <interface> detail
+    if details:
+        with timings.phase(device, "write", commands[2]):
+            SegmentStore(os.path.join(ON_PREM_OUTPUT_DIR, device)).append(details)
+
+    return reachable, output_data
 
 
 def collect(device):
     """
     Collects CLI data from switch based on a list of commands.
     The data is saved locally on the disk.
-    Returns: data.
+    Returns: (reachable, telemetry); a switch that parses or transforms
+    badly is still reachable.
     """
 
     json_body = {}
-    commands = [
-        "show env all",
-        "show power inline",  # Must be at index 1
-        "show power inline %s detail",  # Must be at index 2
-        "show version",
-        "show cdp neighbors",  # Must be at index 4
-        # "show energywise",
-        # "show env temperature status"
-    ]
-    payload = connect_collect(device, commands)
+    reachable, payload = connect_collect(device, COMMANDS)
 
     try:
-        # show env all
-        if "show env all" in payload:
-            switchstack = payload["show env all"]["switch"]
-            for switch in switchstack:
-                log.info("Device {} - switch {}.".format(payload["device"], switch))
-                device = "{}_{}".format(payload["device"], switch)
-                values = {}
-                if "fan" in switchstack[switch]:
-                    for fan in switchstack[switch]["fan"]:
-                        values["fan_{}_state".format(fan)] = switchstack[switch]["fan"][
-                            fan
-                        ]["state"]
-                else:
-                    log.warning("No FAN information for {}".format(device))
-
-                if "hotspot_temperature" in switchstack[switch]:
-                    values["hotspot_temperature"] = float(
-                        switchstack[switch]["hotspot_temperature"]["value"]
-                    )
-                else:
-                    log.warning(
-                        "No hotspot_temperature information for {}".format(device)
-                    )
-
-                if "inlet_temperature" in switchstack[switch]:
-
-                    values["inlet_temperature"] = float(
-                        switchstack[switch]["inlet_temperature"]["value"]
-                    )
-                else:
-                    log.warning(
-                        "No inlet_temperature information for {}".format(device)
-                    )
-
-                if "outlet_temperature" in switchstack[switch]:
-                    values["outlet_temperature"] = float(
-                        switchstack[switch]["outlet_temperature"]["value"]
-                    )
-                else:
-                    log.warning(
-                        "No outlet_temperature information for {}".format(device)
-                    )
+        json_body = power.switch_telemetry(payload)
 
-                # show power inline
-                if payload["show power inline"]:
-                    pw_inline_watts = payload["show power inline"]["watts"]
-                    try:
-                        values["watts_available"] = int(
-                            pw_inline_watts[str(switch)]["available"]
-                        )
-                        values["watts_remaining"] = int(
-                            pw_inline_watts[str(switch)]["remaining"]
-                        )
-                        values["used"] = int(pw_inline_watts[str(switch)]["used"])
-                    except KeyError:
-                        values["watts_available"] = int(
-                            pw_inline_watts[switch]["available"]
-                        )
-                        values["watts_remaining"] = int(
-                            pw_inline_watts[switch]["remaining"]
-                        )
-                        values["used"] = int(pw_inline_watts[switch]["used"])
-
-                    pw_inline_interfaces = payload["show power inline"]["interface"]
-                    total_power = 0
-                    for intf in pw_inline_interfaces:
-                        # TODO(): more robust testing
-                        if "{}/0/".format(switch) in intf:
-                            values["{}_oper_state".format(intf)] = pw_inline_interfaces[
-                                intf
-                            ]["oper_state"]
-                            values["{}_power".format(intf)] = int(
-                                pw_inline_interfaces[intf]["power"]
-                            )
-                            values["{}_device".format(intf)] = pw_inline_interfaces[
-                                intf
-                            ].get("device", None)
-                            total_power += int(pw_inline_interfaces[intf]["power"])
-                    values["total_interfaces_power"] = total_power
-                else:
-                    values["total_interfaces_power"] = 0
-
-                # show energywise
-                # values["energywise"] = float(payload['show energywise'])
-                tb_payload = {"ts": payload["date"], "values": values}
-                json_body[device] = [tb_payload]
+        if PUBLISH_APS and json_body:
+            json_body.update(power.ap_telemetry(payload, cdp_neighbors.get(device, [])))
     except Exception as e:
         log.error(traceback.format_exc())
         log.error("Error on device : {}".format(device))
 
-    return json_body
+    return reachable, json_body
 
 
 def main(argv):
     """Parses arguments and loads metadata."""
 
-    global client, broker, broker_file, testbed, testbed_file, DRY_RUN, CDP_SAMPLED_ONCE
+    global client, broker, broker_file, testbed, testbed_file, DRY_RUN
+    global IO_WORKERS, PARSE_WORKERS, RECYCLE_AFTER, PUBLISH_TIMINGS, SCHEMA, STORE
+    global PUBLISH_APS, EXTRA_STORE, RETENTION_DAYS
 
     try:
         opts, args = getopt.getopt(
-            argv, "mtdbp:", ["brokerfile=", "testbedyml=", "dry-run"]
+            argv,
+            "mtdbp:",
+            [
+                "brokerfile=",
+                "testbedyml=",
+                "dry-run",
+                "io-workers=",
+                "parse-workers=",
+                "recycle-after=",
+                "publish-timings",
+                "schema=",
+                "store=",
+                "publish-aps",
+                "extra-store=",
+                "retention-days=",
+            ],
         )
     except getopt.GetoptError:
         log.error(
             "streamer_switches.py --brokerfile=<mqttbrokerfileyml> --testbedyml=<testbedsyml>"
+            + " [--io-workers=<threads>] [--parse-workers=<processes>]"
+            + " [--recycle-after=<tasks>] [--publish-timings]"
+            + " [--schema=flat|ports|compact] [--store=files|segments]"
+            + " [--publish-aps] [--extra-store=files|archive|none]"
+            + " [--retention-days=<days>]"
         )
         sys.exit(2)
     for opt, arg in opts:
@@ -323,6 +386,27 @@ def main(argv):
             testbed_file = arg
         if opt in ("-d", "--dry-run"):
             DRY_RUN = True
+        if opt == "--io-workers":
+            IO_WORKERS = int(arg)
+        if opt == "--parse-workers":
+            PARSE_WORKERS = int(arg)
+        if opt == "--recycle-after":
+            RECYCLE_AFTER = int(arg)
+        if opt == "--publish-timings":
+            PUBLISH_TIMINGS = True
+        if opt == "--schema":
+            if arg not in power.SCHEMAS:
+                log.error("Unknown schema %s, expected one of %s", arg, power.SCHEMAS)
+                sys.exit(2)
+            SCHEMA = arg
+        if opt == "--store":
+            STORE = arg
+        if opt == "--publish-aps":
+            PUBLISH_APS = True
+        if opt == "--extra-store":
+            EXTRA_STORE = arg
+        if opt == "--retention-days":
+            RETENTION_DAYS = int(arg)
 
     log.info("§§§ On-prem-only streaming. §§§")
     os.makedirs(ON_PREM_OUTPUT_DIR, exist_ok=True)
@@ -347,26 +431,101 @@ if __name__ == "__main__":
 
     this_file = os.path.basename(__file__)
 
+    # Skip unreachable switches instead of waiting for the connection timeout
+    breakers = FleetBreaker()
+
+    # Many I/O threads fetch raw CLI outputs, a process pool sized to the
+    # cores parses them. Both pools live for the whole run; parser processes
+    # start with their parsers loaded and are recycled to limit memory growth.
+    parse_pool = Pool(
+        processes=PARSE_WORKERS,
+        initializer=parsing.init_worker,
+        initargs=({d.os for d in testbed.devices.values()}, COMMANDS),
+        maxtasksperchild=RECYCLE_AFTER,
+    )
+    p = ThreadPool(processes=IO_WORKERS)
+
+    # Index of the APs' switch ports, read by streamer_aps, onboarding and exporter
+    topology = Topology.load()
+
+    # Per-device, per-phase timings, saved under TIMINGS_DIR every cycle
+    timings = Timings()
+
+    # Attributes of the compact schemas, published only when they change
+    published_attributes = {}
+
+    # Raw and parsed outputs of power.ARCHIVED_COMMANDS, for backfill and reprocess
+    archive_store = ArchiveStore(EXTRA_OUTPUT_DIR)
+    last_compaction = 0
+
     while True:
-        # with ThreadPool(processes=4) as p:
-        with Pool(processes=4) as p:
-            collections = p.map(collect, testbed.devices)
+        devices = breakers.allowed(list(testbed.devices))
+        results = p.map(collect, devices)
+
+        # Only a failed connection opens the circuit of a switch
+        for device, result in zip(devices, results):
+            breakers.record(device, result[0])
+        breakers.log_summary()
+        collections = [result[1] for result in results if result[1]]
+
+        # Keep the archive within its retention
+        if (
+            EXTRA_STORE == "archive"
+            and not DRY_RUN
+            and time.time() - last_compaction >= COMPACT_EVERY_S
+        ):
+            archive_store.compact(int(time.time_ns() / 1000000), RETENTION_DAYS)
+            last_compaction = time.time()
+
+        # Re-encode the per-port values, static strings become attributes
+        attributes = {}
+        if SCHEMA != "flat":
+            flat_size = power.payload_size(collections)
+            collections, attributes = power.encode_schema(collections, SCHEMA)
+            log.info(
+                "Payload size: %i bytes with schema %s, %i bytes with schema flat",
+                power.payload_size(collections),
+                SCHEMA,
+                flat_size,
+            )
+            attributes = {
+                device: a
+                for device, a in attributes.items()
+                if published_attributes.get(device) != a
+            }
 
         if DRY_RUN:
             for c in collections:
                 print(json.dumps(c))
+            timings.write(TIMINGS_DIR)
+            continue
+
+        if not collections:
+            # e.g. all the circuits are open
+            log.info("No data gathered.")
+            timings.write(TIMINGS_DIR)
+            time.sleep(330)
             continue
 
         # Post data to Thingsboard
         client = mqttutils.create_client(broker, this_file)
         log.info("Finished gathering data.")
 
+        with timings.phase("streamer", "publish"):
+            msg_info = mqttutils.publish_collections_telemetry(
+                client, collections, sleep_once_s=0
+            )
+        if attributes:
+            mqttutils.publish_attributes(client, attributes)
+            published_attributes.update(attributes)
+        if PUBLISH_TIMINGS:
+            mqttutils.publish_collections_telemetry(
+                client, [timings.telemetry()], sleep_once_s=0
+            )
+        timings.write(TIMINGS_DIR)
+
         # Publish every 5 minutes but give MQTT client
         # 60s time to post messages before disconnecting
-        msg_info = mqttutils.publish_collections_telemetry(
-            client, collections, sleep_once_s=60
-        )
-
+        time.sleep(60)
         client.disconnect()
         time.sleep(270)
-        CDP_SAMPLED_ONCE = True
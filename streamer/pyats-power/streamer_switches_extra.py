@@ -22,6 +22,16 @@ This script runs only on real devices.
 
 Cadence: 1h.
 
+Each command runs once on the switch; its raw output is saved (.cli) and
+parsed from the capture in a process pool (.json). With --capture-only,
+only the raw outputs are saved; reparse.py generates the JSON files later,
+or again when parsers improve (files store only).
+
+With --store=archive, the outputs are stored once per distinct content,
+compressed, with a manifest of time pointers per switch (see
+utils/archive.py); the archive is compacted daily to its retention
+(--retention-days, default 90) and optional disk budget (--max-archive-mb).
+
 Naming convention for switch name:
 switch_name
 
@@ -33,7 +43,7 @@ Run example:
   pip3 install -r streamer/pyats-power/requirements.txt
 
   python3.9 -m streamer.pyats-power.streamer_switches_extra \
-    --testbedyml=onboard/testbed.yml [--dry-run]
+    --testbedyml=onboard/testbed.yml [--dry-run] [--capture-only]
 
 Run example as a service:
   cd <main folder>
@@ -46,30 +56,76 @@ import json
 import time
 import getopt
 import traceback
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
 
 import unicon
 from pyats.topology import loader
 import pyats.utils.yaml.exceptions
-from genie.libs.parser.utils.common import ParserNotFound
 
+from ..utils import parsing
 from ..utils.logger import log
+from ..utils.breaker import FleetBreaker
+from ..utils.archive import ArchiveStore
 
 # Set default paths
 testbed_file = "/onboard/testbed.yml"
 
 DRY_RUN = False  # Set to true for data display
+CAPTURE_ONLY = False  # Set to true to save raw outputs only, parsed by reparse.py
+PARSE_WORKERS = os.cpu_count()  # Processes parsing CLI outputs
+STORE = "files"  # Storage of the outputs: files or archive (see utils/archive.py)
+RETENTION_DAYS = 90  # Retention of the archive
+MAX_ARCHIVE_BYTES = None  # Disk budget of the archive, None for no limit
+COMPACT_EVERY_S = 24 * 3600  # Period of the compaction of the archive
 ON_PREM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "extra-output")
 
+COMMANDS = [
+    "show environment",
+    "show environment all",
+    "show environment power all",
+    # "show environment status",
+    # "show environment stack",
+    # "show environment fan",
+    # "show power",
+    "show power status all",
+    "show power total",
+    "show power available",
+    "show power used",
+    # "show stack-power details",
+    "show version",
+    "show int status",
+    # "show energywise",
+]
+
+
+def save(device, command, timestamp, fmt, content):
+    """Saves an output of a command (fmt: cli or json) on the local disk."""
+
+    if STORE == "archive":
+        archive.put(device, timestamp, command, fmt, content)
+        return
+
+    device_dir = os.path.join(ON_PREM_OUTPUT_DIR, device, "_".join(command.split(" ")))
+    os.makedirs(device_dir, exist_ok=True)
+    with open(
+        os.path.join(device_dir, timestamp + "." + fmt), "w", encoding="utf-8"
+    ) as output_file:
+        output_file.write(content)
+
 
 def connect_collect_and_save_data(device, commands):
     """
     Connects to switch, collects CLI data and save it on the local disk.
-    Returns: data.
+    Each command runs once; its captured output is parsed in the parser pool,
+    after the session is closed, unless CAPTURE_ONLY (see reparse.py).
+    Returns: (reachable, data).
     """
 
+    reachable = True
     cli_format_data = {}
     json_format_data = {}
+    results = {}
     d = testbed.devices[device]
 
     try:
@@ -80,100 +136,112 @@ def connect_collect_and_save_data(device, commands):
             try:
                 # Use CLI format
                 cli_format_out = d.execute(command)
-                json_format_out = d.parse(command)
                 cli_format_data[command] = cli_format_out
-                json_format_data[command] = json_format_out
-
                 if not DRY_RUN:
-                    # Create device directory
-                    device_dir = os.path.join(
-                        ON_PREM_OUTPUT_DIR, device, "_".join(command.split(" "))
+                    save(device, command, timestamp, "cli", cli_format_out)
+                if not CAPTURE_ONLY:
+                    results[command] = parse_pool.apply_async(
+                        parsing.parse_output, ((d.os, command, cli_format_out),)
                     )
-                    os.makedirs(device_dir, exist_ok=True)
-
-                    # Save files in directory in 2 formats: CLI and JSON
-                    with open(
-                        os.path.join(device_dir, timestamp + ".cli"),
-                        "w",
-                        encoding="utf-8",
-                    ) as output_file:
-                        output_file.write(cli_format_data[command])
-                    with open(
-                        os.path.join(device_dir, timestamp + ".json"),
-                        "w",
-                        encoding="utf-8",
-                    ) as output_file:
-                        output_file.write(
-                            json.dumps(json_format_data[command], indent=2)
-                        )
-
-            except ParserNotFound:
-                log.warning(
-                    '{}: No parser found for command : "{}"'.format(device, command)
-                )
             except Exception as e:
                 log.warning(
                     "{}: Exception on [running] command {}: {}".format(
                         device, command, e
                     )
                 )
-
         d.disconnect()
     except unicon.core.errors.ConnectionError:
         log.warning("Cannot connect to device {}".format(device))
-    return cli_format_data
+        reachable = False
+
+    # Save files in 2 formats: CLI (above) and JSON, once parsed
+    for command, result in results.items():
+        try:
+            json_format_out = result.get()
+        except Exception as e:
+            log.warning(
+                "{}: Exception on [parsing] command {}: {}".format(device, command, e)
+            )
+            continue
+        if json_format_out is None:  # No parser found for command
+            continue
+        json_format_data[command] = json_format_out
+        if not DRY_RUN:
+            save(
+                device,
+                command,
+                timestamp,
+                "json",
+                json.dumps(json_format_out, indent=2),
+            )
+
+    return reachable, cli_format_data
 
 
 def collect(device):
     """
     Collects CLI data from switch based on a list of commands.
     The data is saved locally on the disk.
-    Returns: data.
+    Returns: (reachable, data).
     """
 
-    commands = [
-        "show environment",
-        "show environment all",
-        "show environment power all",
-        # "show environment status",
-        # "show environment stack",
-        # "show environment fan",
-        # "show power",
-        "show power status all",
-        "show power total",
-        "show power available",
-        "show power used",
-        # "show stack-power details",
-        "show version",
-        "show int status"
-        # "show energywise",
-    ]
     try:
-        payload = connect_collect_and_save_data(device, commands)
-        return payload
+        return connect_collect_and_save_data(device, COMMANDS)
 
     except Exception as e:
         log.error(traceback.format_exc())
         log.error("Error on device : {}".format(device))
 
-    return None
+    return (True, None)
 
 
 def main(argv):
     """Parses arguments and loads metadata."""
 
-    global testbed, testbed_file, DRY_RUN
+    global testbed, testbed_file, DRY_RUN, CAPTURE_ONLY, PARSE_WORKERS, STORE
+    global RETENTION_DAYS, MAX_ARCHIVE_BYTES
 
     try:
-        opts, args = getopt.getopt(argv, "td:", ["testbedyml=", "dry-run"])
+        opts, args = getopt.getopt(
+            argv,
+            "td:",
+            [
+                "testbedyml=",
+                "dry-run",
+                "capture-only",
+                "parse-workers=",
+                "store=",
+                "retention-days=",
+                "max-archive-mb=",
+            ],
+        )
     except getopt.GetoptError:
-        log.error("streamer_switches_extra.py --testbedyml=<testbedsyml>")
+        log.error(
+            "streamer_switches_extra.py --testbedyml=<testbedsyml>"
+            + " [--capture-only] [--parse-workers=<processes>]"
+            + " [--store=files|archive] [--retention-days=<days>]"
+            + " [--max-archive-mb=<MB>]"
+        )
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("-t", "--testbedyml"):
             testbed_file = arg
         if opt in ("-d", "--dry-run"):
             DRY_RUN = True
+        if opt == "--capture-only":
+            CAPTURE_ONLY = True
+        if opt == "--parse-workers":
+            PARSE_WORKERS = int(arg)
+        if opt == "--store":
+            STORE = arg
+        if opt == "--retention-days":
+            RETENTION_DAYS = int(arg)
+        if opt == "--max-archive-mb":
+            MAX_ARCHIVE_BYTES = int(arg) * 1024 * 1024
+    if CAPTURE_ONLY and STORE == "archive":
+        # reparse.py reads the .cli files of the files store only
+        log.error("--capture-only requires --store=files, reparse.py reads files")
+        sys.exit(2)
 
     log.info("§§§ On-prem-only collection. §§§")
     os.makedirs(ON_PREM_OUTPUT_DIR, exist_ok=True)
@@ -192,14 +260,44 @@ if __name__ == "__main__":
 
     this_file = os.path.basename(__file__)
 
+    # Skip unreachable switches instead of waiting for the connection timeout
+    breakers = FleetBreaker(base_backoff_s=3600, max_backoff_s=6 * 3600)
+
+    # Deduplicated, compressed archive of the outputs
+    archive = ArchiveStore(ON_PREM_OUTPUT_DIR)
+    last_compaction = 0
+
+    # Captured outputs are parsed in a process pool, away from the sessions
+    if not CAPTURE_ONLY:
+        parse_pool = Pool(
+            processes=PARSE_WORKERS,
+            initializer=parsing.init_worker,
+            initargs=({d.os for d in testbed.devices.values()}, COMMANDS),
+        )
+
     while True:
+        devices = breakers.allowed(list(testbed.devices))
+
         with ThreadPool(processes=4) as p:
-            collections = p.map(collect, testbed.devices)
+            results = p.map(collect, devices)
+
+        # Only a failed connection opens the circuit of a switch
+        for device, result in zip(devices, results):
+            breakers.record(device, result[0])
+        breakers.log_summary()
+        collections = [result[1] for result in results]
 
         if DRY_RUN:
             for c in collections:
                 print(json.dumps(c))
             continue
 
+        # Keep the archive within its retention and disk budget
+        if STORE == "archive" and time.time() - last_compaction >= COMPACT_EVERY_S:
+            archive.compact(
+                int(time.time_ns() / 1000000), RETENTION_DAYS, MAX_ARCHIVE_BYTES
+            )
+            last_compaction = time.time()
+
         # Sleep 1h
         time.sleep(3600)
@@ -0,0 +1,204 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Content-addressed archive of the CLI outputs of the switches.
+
+Identical outputs (e.g. "show version" from hour to hour) are stored once,
+as a compressed blob named after the hash of their content; each device
+keeps a manifest of time pointers to the blobs.
+
+Layout, under the archive root:
+  blobs/<2 first hex>/<hash>.gz     gzip content, shared by all devices
+  <device>/manifest.tsv             one line per output, in time order:
+                                    <ts>\t<command>\t<format>\t<hash>
+
+Formats: "cli" (raw text) and "json" (parsed output).
+
+Compaction drops the time pointers older than the retention, and further
+the oldest ones while the blobs exceed max_bytes, then removes the blobs
+no manifest points to.
+"""
+
+import os
+import gzip
+import hashlib
+import threading
+
+from .logger import log
+
+BLOBS_DIR = "blobs"
+MANIFEST_FILE = "manifest.tsv"
+HASH_LENGTH = 32  # Hex digits of the SHA-256 of the content kept in names
+DAY_MS = 24 * 3600 * 1000
+
+
+class ArchiveStore:
+    """A class that represents the archive of the CLI outputs of the switches."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, BLOBS_DIR, digest[:2], digest + ".gz")
+
+    def _manifest_path(self, device):
+        return os.path.join(self.root, device, MANIFEST_FILE)
+
+    def devices(self):
+        """Returns: names of the devices with a manifest."""
+
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            d for d in os.listdir(self.root) if os.path.exists(self._manifest_path(d))
+        ]
+
+    def put(self, device, ts, command, fmt, content):
+        """
+        Archives an output of a command; its blob is written only if no
+        identical output was archived before.
+
+        Returns: hash of the content.
+        """
+
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        blob = self._blob_path(digest)
+        if not os.path.exists(blob):
+            # Threads may write the same blob: one temporary file each
+            tmp = "{}.{}-{}.tmp".format(blob, os.getpid(), threading.get_ident())
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            with gzip.open(tmp, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp, blob)
+
+        os.makedirs(os.path.join(self.root, device), exist_ok=True)
+        with open(self._manifest_path(device), "a", encoding="utf-8") as fp:
+            fp.write("{}\t{}\t{}\t{}\n".format(int(ts), command, fmt, digest))
+        return digest
+
+    def get(self, digest):
+        """Returns: content of a blob."""
+
+        with gzip.open(self._blob_path(digest), "rb") as fp:
+            return fp.read().decode("utf-8")
+
+    def records(self, device, command=None, fmt=None, start=0, end=None):
+        """
+        Iterates over the time pointers of a device, in time order.
+
+        Returns: generator of (ts, command, format, hash).
+        """
+
+        try:
+            fp = open(self._manifest_path(device), encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    ts, record_command, record_fmt, digest = line.rstrip("\n").split(
+                        "\t"
+                    )
+                except ValueError:
+                    # Partial line of an interrupted write
+                    continue
+                ts = int(ts)
+                if ts < start or (command and record_command != command):
+                    continue
+                if end is not None and ts > end:
+                    break
+                if fmt and record_fmt != fmt:
+                    continue
+                yield (ts, record_command, record_fmt, digest)
+
+    def _blobs(self):
+        """Returns: {hash: (path, size)} of the blobs."""
+
+        blobs = {}
+        blobs_dir = os.path.join(self.root, BLOBS_DIR)
+        if not os.path.isdir(blobs_dir):
+            return blobs
+        for prefix in os.listdir(blobs_dir):
+            for name in os.listdir(os.path.join(blobs_dir, prefix)):
+                if name.endswith(".gz"):
+                    path = os.path.join(blobs_dir, prefix, name)
+                    blobs[name[: -len(".gz")]] = (path, os.path.getsize(path))
+        return blobs
+
+    def _truncate(self, device, cutoff):
+        """Drops the time pointers of a device older than cutoff."""
+
+        path = self._manifest_path(device)
+        with open(path, encoding="utf-8") as fp, open(
+            path + ".tmp", "w", encoding="utf-8"
+        ) as out:
+            for line in fp:
+                ts = line.split("\t", 1)[0]
+                if ts.isdigit() and int(ts) >= cutoff:
+                    out.write(line)
+        os.replace(path + ".tmp", path)
+
+    def _gc(self):
+        """
+        Removes the blobs no manifest points to.
+
+        Returns: (bytes reclaimed, {hash: (size, last ts)} of the other blobs).
+        """
+
+        referenced = {}
+        for device in self.devices():
+            for ts, _, _, digest in self.records(device):
+                referenced[digest] = max(ts, referenced.get(digest, ts))
+
+        reclaimed, kept = 0, {}
+        for digest, (path, size) in self._blobs().items():
+            if digest in referenced:
+                kept[digest] = (size, referenced[digest])
+            else:
+                os.remove(path)
+                reclaimed += size
+        return reclaimed, kept
+
+    def compact(self, now_ms, retention_days, max_bytes=None):
+        """
+        Applies the retention, then removes the blobs no longer pointed to.
+
+        Returns: bytes reclaimed.
+        """
+
+        cutoff = now_ms - retention_days * DAY_MS
+        for device in self.devices():
+            self._truncate(device, cutoff)
+        reclaimed, kept = self._gc()
+
+        total = sum(size for size, _ in kept.values())
+        if max_bytes is not None and total > max_bytes:
+            # Over budget: drop the outputs up to the last use of the
+            # least recently used blobs
+            log.info("Archive of %i bytes over %i bytes", total, max_bytes)
+            for size, last_ts in sorted(kept.values(), key=lambda v: v[1]):
+                if total <= max_bytes:
+                    break
+                total -= size
+                cutoff = last_ts + 1
+            for device in self.devices():
+                self._truncate(device, cutoff)
+            reclaimed += self._gc()[0]
+
+        log.info("Compacted archive %s, reclaimed %i bytes", self.root, reclaimed)
+        return reclaimed
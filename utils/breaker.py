@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Per-device circuit breakers for the switch collectors.
+
+A device whose connection keeps failing is skipped ("open" circuit) until
+its next probe time. The probe delay doubles after every failed probe,
+up to a maximum. Once the delay expires, a single connection attempt is
+allowed ("half-open"): success closes the circuit, failure reopens it.
+"""
+
+import time
+import threading
+
+from .logger import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """A class that represents the circuit of a single device."""
+
+    def __init__(
+        self, device, failure_threshold=2, base_backoff_s=300, max_backoff_s=3600
+    ):
+        self.device = device
+        self.failure_threshold = failure_threshold
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.next_probe = 0
+
+    def allow(self, now=None):
+        """Returns True if a connection attempt is allowed for the device."""
+
+        now = now or time.time()
+        if self.state == OPEN and now >= self.next_probe:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def record_success(self):
+        if self.state != CLOSED:
+            log.info("Circuit closed for device %s", self.device)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.next_probe = 0
+
+    def record_failure(self, now=None):
+        now = now or time.time()
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            # Exponential backoff on the number of failures past the threshold
+            exponent = max(self.failures - self.failure_threshold, 0)
+            backoff = min(self.base_backoff_s * 2**exponent, self.max_backoff_s)
+            if self.state == CLOSED:
+                self.opened_at = now
+            self.state = OPEN
+            self.next_probe = now + backoff
+            log.warning(
+                "Circuit open for device %s after %i failures, next probe in %is",
+                self.device,
+                self.failures,
+                backoff,
+            )
+
+
+class FleetBreaker:
+    """A class that holds the circuit breakers of all devices."""
+
+    def __init__(self, **breaker_args):
+        self._breaker_args = breaker_args
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, device):
+        with self._lock:
+            if device not in self._breakers:
+                self._breakers[device] = CircuitBreaker(device, **self._breaker_args)
+            return self._breakers[device]
+
+    def allowed(self, devices):
+        """
+        Filters the devices for which a connection attempt is allowed.
+
+        Returns: list of devices.
+        """
+
+        now = time.time()
+        allowed = [d for d in devices if self.get(d).allow(now)]
+        skipped = len(devices) - len(allowed)
+        if skipped:
+            log.info("Skipping %i device(s) with open circuits", skipped)
+        return allowed
+
+    def record(self, device, success):
+        if success:
+            self.get(device).record_success()
+        else:
+            self.get(device).record_failure()
+
+    def open_circuits(self):
+        """
+        Fleet view of devices that are currently not collected.
+
+        Returns: {device: {"state", "failures", "opened_at", "next_probe"}}.
+        """
+
+        with self._lock:
+            return {
+                b.device: {
+                    "state": b.state,
+                    "failures": b.failures,
+                    "opened_at": b.opened_at,
+                    "next_probe": b.next_probe,
+                }
+                for b in self._breakers.values()
+                if b.state != CLOSED
+            }
+
+    def log_summary(self):
+        circuits = self.open_circuits()
+        if circuits:
+            log.warning(
+                "Open circuits: %i/%i devices - %s",
+                len(circuits),
+                len(self._breakers),
+                sorted(circuits),
+            )
@@ -15,40 +15,191 @@ IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 or implied.
 """
 """
-Supports cdp information processing.
+Supports cdp (and lldp) information processing.
+
+Neighbors are classified by rules, loaded once from the YAML file in env
+variable NEIGHBOR_RULES_FILE (default /onboard/neighbors.yml), or else the
+built-in rules below. Each rule holds regular expressions, compiled once:
+  class       class of the matching neighbors, e.g. ap
+  platform    searched in the platform (cdp) or system description (lldp)
+  name        optional, searched in the device id; neighbors that do not
+              match are skipped. With groups, group 1 is the name used.
+
+A rule without class or platform, or with an invalid expression, is
+rejected with a ValueError when the rules are loaded.
+
+The first matching rule applies.
 """
 
-from .ap import AP
+import os
+import re
+
+import yaml
+
 from .logger import log
 
+RULES_FILE = os.getenv("NEIGHBOR_RULES_FILE", "/onboard/neighbors.yml")
+MAX_PLATFORMS = 10000  # Platform strings of which the rule is cached
+DEFAULT_RULES = [{"class": "ap", "platform": "AX|AIR-|Cisco AP Software"}]
+
+_classifier = None
+
+
+class NeighborClassifier:
+    """
+    A class that classifies the neighbors of a switch by rules.
+
+    The patterns of each rule are compiled once, and checked when the rules
+    are loaded; the rule of each platform string is cached: a table has
+    hundreds of neighbors but a few platforms.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self.classes, self.platforms, self.names = [], [], []
+        for i, rule in enumerate(rules):
+            try:
+                self.classes.append(rule["class"])
+                self.platforms.append(re.compile(rule["platform"], re.DOTALL))
+                self.names.append(
+                    re.compile(rule["name"]) if rule.get("name") else None
+                )
+            except KeyError as e:
+                raise ValueError(
+                    "Invalid neighbor rule {}, missing {}: {!r}".format(i + 1, e, rule)
+                ) from e
+            except (TypeError, re.error) as e:
+                raise ValueError(
+                    "Invalid neighbor rule {} ({}): {!r}".format(i + 1, e, rule)
+                ) from e
+        self._rules = {}  # platform -> index of the rule, None if none applies
+
+    @classmethod
+    def load(cls, path=RULES_FILE):
+        """Returns: classifier of the rules file, or of the default rules."""
+
+        if not os.path.exists(path):
+            return cls()
+        with open(path, encoding="utf-8") as fp:
+            rules = yaml.load(fp, Loader=yaml.Loader)["rules"]
+        log.info("Loaded %i neighbor rules from %s", len(rules), path)
+        return cls(rules)
+
+    def rule(self, platform):
+        """Returns: index of the first rule matching the platform, None if none."""
+
+        try:
+            return self._rules[platform]
+        except KeyError:
+            index = next(
+                (i for i, p in enumerate(self.platforms) if p.search(platform)), None
+            )
+            if len(self._rules) < MAX_PLATFORMS:
+                self._rules[platform] = index
+            return index
+
+    def classify(self, entries, neighbor_class=None):
+        """
+        Classifies a neighbor table in one pass.
+        Expects: entries = iterable of (device id, platform, local interface)
+
+        Returns: {class: [(name, local interface)]}, or the list of
+        neighbor_class only if given.
+        """
+
+        classes = {}
+        for device_id, platform, interface in entries:
+            index = self.rule(platform)
+            if index is None:
+                continue
+            name = device_id
+            if self.names[index]:
+                match = self.names[index].search(device_id)
+                if not match:
+                    log.debug("Neighbor %s has an invalid name", device_id)
+                    continue
+                name = match.group(1) if match.groups() else match.group(0)
+            classes.setdefault(self.classes[index], []).append((name, interface))
+        log.debug(
+            "Neighbors: %s", {c: len(neighbors) for c, neighbors in classes.items()}
+        )
+
+        if neighbor_class is not None:
+            return classes.get(neighbor_class, [])
+        return classes
+
+
+def classifier():
+    """Returns: the classifier of the process, loaded on first use."""
+
+    global _classifier
+    if _classifier is None:
+        _classifier = NeighborClassifier.load()
+    return _classifier
+
+
+def cdp_entries(data):
+    """
+    Returns: (device id, platform, local interface) of the neighbors of
+    'show cdp neighbors', as parsed by PyATS.
+    """
+
+    return (
+        (n["device_id"], n.get("platform", ""), n["local_interface"])
+        for n in data["cdp"]["index"].values()
+    )
+
+
+def lldp_entries(data):
+    """
+    Returns: (device id, system description, local interface) of the
+    neighbors of 'show lldp neighbors detail', as parsed by PyATS.
+    """
+
+    return (
+        (
+            n.get("system_name") or name,
+            n.get("system_description", ""),
+            interface,
+        )
+        for interface, local in data.get("interfaces", {}).items()
+        for port in local.get("port_id", {}).values()
+        for name, n in port.get("neighbors", {}).items()
+    )
+
 
 def get_cdp_neighbors(data):
     """
-    Extracts CDP neighbors from a dictionary, as outputted by
+    Extracts the AP neighbors from a dictionary, as outputted by
     PyATS's processing of the 'show cdp neighbors' IOS-XE CLI command.
 
-    Returns: cdp_neighbors.
+    Returns: cdp_neighbors = [(AP name, local interface)].
     """
 
-    cdp_neighbors = []
+    return classifier().classify(cdp_entries(data), "ap")
 
-    for neighbor in data["cdp"]["index"].items():
-        if "AX" in neighbor[1]["platform"] or "AIR-" in neighbor[1]["platform"]:
-            ap = AP(neighbor[1]["device_id"])
 
-            # Optionally, enable AP name validation
-            # if ap.is_valid():
-            #    ap_name = ap.full_name()
-            if True:
-                # Replace this with validated name above
-                ap_name = ap.id
+def get_lldp_neighbors(data):
+    """
+    Extracts the AP neighbors from a dictionary, as outputted by PyATS's
+    processing of the 'show lldp neighbors detail' IOS-XE CLI command.
 
-                cdp_neighbors.append((ap_name, neighbor[1]["local_interface"]))
-                log.debug(
-                    "AP %s: %s - %s",
-                    neighbor[0],
-                    ap_name,
-                    neighbor[1]["local_interface"],
-                )
+    Returns: [(AP name, local interface)].
+    """
+
+    return classifier().classify(lldp_entries(data), "ap")
+
+
+def diff_neighbors(old, new):
+    """
+    Compares two mappings of the APs to their switch ports,
+    {AP: (switch, local interface)}.
+
+    Returns: (added, moved, removed), added and moved as
+    {AP: (switch, local interface)}, removed as [AP].
+    """
+
+    added = {ap: port for ap, port in new.items() if ap not in old}
+    moved = {ap: port for ap, port in new.items() if ap in old and old[ap] != port}
+    removed = [ap for ap in old if ap not in new]
 
-    return cdp_neighbors
+    return added, moved, removed
@@ -0,0 +1,155 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Local cache of the timeseries read from Thingsboard, in SQLite, so that
+repeated exports read only the time ranges not read before.
+
+Tables:
+  samples (device, series, ts, value)         values read, series: key,
+                                              aggregation and interval,
+                                              e.g. PoE/AVG/3600000
+  ranges (device, series, start_ts, end_ts)   time ranges read completely
+
+Ranges ending less than refresh_ms ago are not recorded as read: their last
+intervals may still change (open interval, late or backfilled data), they
+are read again by the next run. The connection is shared by threads.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from .logger import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    device TEXT NOT NULL, series TEXT NOT NULL, ts INTEGER NOT NULL, value REAL,
+    PRIMARY KEY (device, series, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ranges (
+    device TEXT NOT NULL, series TEXT NOT NULL,
+    start_ts INTEGER NOT NULL, end_ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ranges_device ON ranges (device, series);
+"""
+
+
+class HistoryCache:
+    """A class that caches the timeseries of devices by time range."""
+
+    def __init__(self, path, refresh_ms=2 * 3600 * 1000, interval_ms=3600 * 1000):
+        self.path = path
+        self.refresh_ms = refresh_ms
+        self.interval_ms = interval_ms  # Ranges recorded end on a multiple
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _ranges(self, device, series):
+        return self._db.execute(
+            "SELECT start_ts, end_ts FROM ranges WHERE device = ? AND series = ?"
+            " ORDER BY start_ts",
+            (device, series),
+        ).fetchall()
+
+    def missing(self, device, series, start, end):
+        """Returns: [(start, end)] of the time ranges not cached, in time order."""
+
+        with self._lock:
+            ranges = self._ranges(device, series)
+
+        gaps = []
+        for range_start, range_end in ranges:
+            if range_end <= start:
+                continue
+            if range_start >= end:
+                break
+            if range_start > start:
+                gaps.append((start, range_start))
+            start = max(start, range_end)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+    def store(self, device, series, start, end, samples):
+        """
+        Caches the samples read over a time range.
+        Expects: samples = [{"ts": ts, "value": value}]
+        """
+
+        # Recent intervals are cached, but read again by the next run
+        settled = int(time.time() * 1000) - self.refresh_ms
+        end = min(end, settled // self.interval_ms * self.interval_ms)
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                [(device, series, s["ts"], float(s["value"])) for s in samples],
+            )
+            if start >= end:
+                return
+
+            # Merge the range with the overlapping and adjacent ones
+            ranges = self._ranges(device, series) + [(start, end)]
+            merged = []
+            for range_start, range_end in sorted(ranges):
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], range_end)
+                else:
+                    merged.append([range_start, range_end])
+            self._db.execute(
+                "DELETE FROM ranges WHERE device = ? AND series = ?", (device, series)
+            )
+            self._db.executemany(
+                "INSERT INTO ranges VALUES (?, ?, ?, ?)",
+                [(device, series, s, e) for s, e in merged],
+            )
+
+    def read(self, device, series, start, end):
+        """Returns: [{"ts": ts, "value": value}] cached over [start, end), in time order."""
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ts, value FROM samples WHERE device = ? AND series = ?"
+                " AND ts >= ? AND ts < ? ORDER BY ts",
+                (device, series, start, end),
+            ).fetchall()
+        return [{"ts": ts, "value": value} for ts, value in rows]
+
+    def invalidate(self, device=None, since=0):
+        """Forgets the cached ranges of a device (all if None) after since (ms)."""
+
+        with self._lock, self._db:
+            where, params = "end_ts > ?", [since]
+            if device is not None:
+                where += " AND device = ?"
+                params.append(device)
+            self._db.execute(
+                "UPDATE ranges SET end_ts = ? WHERE start_ts < ? AND " + where,
+                [since, since] + params,
+            )
+            self._db.execute(
+                "DELETE FROM ranges WHERE start_ts >= ? AND " + where, [since] + params
+            )
+        log.info("Invalidated the cache of %s since %i", device or "all devices", since)
@@ -38,6 +38,7 @@ def read_cdp_neigbors(source):
     # Get all CDP neighbors
     with open(cdp_file, encoding="utf-8") as fp:
         data = json.load(fp)
-        cdp_neighbors = get_cdp_neighbors(data)
+        # Saved as {} when the switch has no CDP neighbors
+        cdp_neighbors = get_cdp_neighbors(data) if data else []
         log.debug("Switch %s has %i CDP entries", switch, len(cdp_neighbors))
         return (switch, cdp_neighbors)
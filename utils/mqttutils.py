@@ -79,9 +79,10 @@ def publish_collections_telemetry(client, collections, sleep_once_s):
 
     Sleeps once sleep_s seconds before finishing.
 
-    Returns: msg_info.
+    Returns: msg_info of the last collection, None if there is none.
     """
 
+    msg_info = None
     for c in collections:
         log.info("Publishing content for %s", str(c.keys()))
 
@@ -100,6 +101,41 @@ def publish_collections_telemetry(client, collections, sleep_once_s):
     return msg_info
 
 
+def publish_collections_confirmed(client, collections, timeout_s):
+    """
+    Publishes collections to Thingsboard's MQTT endpoint "v1/gateway/telemetry"
+    with QOS=1, and waits up to timeout_s for the broker to acknowledge them.
+
+    Returns: the collections acknowledged, in order.
+    """
+
+    messages = []
+    for c in collections:
+        log.info("Publishing content for %s", str(c.keys()))
+        msg_info = client.publish(
+            "v1/gateway/telemetry", json.dumps(c), qos=1, retain=False
+        )
+        messages.append((c, msg_info))
+
+    deadline = time.time() + timeout_s
+    delivered = []
+    for c, msg_info in messages:
+        try:
+            msg_info.wait_for_publish(max(deadline - time.time(), 0))
+        except (RuntimeError, ValueError) as exc:  # e.g. not connected
+            log.error("ERROR on telemetry publish: %s", str(exc))
+        if msg_info.is_published():
+            delivered.append(c)
+    if len(delivered) < len(messages):
+        log.warning(
+            "%i of %i collections not acknowledged by the broker",
+            len(messages) - len(delivered),
+            len(messages),
+        )
+
+    return delivered
+
+
 def publish_connect_device(client, body):
     """
     Publishes the JSON body to Thingsboard's MQTT endpoint "v1/gateway/connect" with QOS=1.
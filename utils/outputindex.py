@@ -0,0 +1,358 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Time index of the switch outputs archived under extra-output, by device,
+command and format, for time-range queries without listing the command
+directories.
+
+Both layouts are indexed:
+  <device>/<command_dir>/<ts>.<format>   files store
+  <device>/manifest.tsv                  archive store, see utils/archive.py
+
+Layout of the index, under the device directory:
+  .index/<command_dir>.<format>.idx   fixed-width records in time order:
+                                      <ts, int64><offset, int64>
+                                      offset: of the manifest line for the
+                                      archive store, -1 for the files store
+  .index/state.json                   what was indexed, for the updates
+
+Queries look up the start of the range by bisection and read the records
+sequentially: memory does not depend on the size of the range. Output
+files rolled into daily bundles by the retention are read from the bundle.
+Updates are incremental; a compacted manifest triggers a rebuild of the
+records of the archive store of the device.
+"""
+
+import os
+import json
+import fcntl
+import contextlib
+import struct
+
+from . import retention
+from .logger import log
+from .archive import ArchiveStore, BLOBS_DIR, MANIFEST_FILE
+
+INDEX_DIR = ".index"
+STATE_FILE = "state.json"
+RECORD = struct.Struct("<qq")  # ts, offset
+READ_RECORDS = 4096  # Records read at once by the queries
+
+
+def command_dir(command):
+    """Returns: directory name of a command, e.g. show_power_total."""
+
+    return "_".join(command.split(" "))
+
+
+class OutputIndex:
+    """A class that indexes the switch outputs archived under a directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self.archive = ArchiveStore(root)
+
+    def _index_dir(self, device):
+        return os.path.join(self.root, device, INDEX_DIR)
+
+    def _index_path(self, device, name, fmt):
+        return os.path.join(self._index_dir(device), "{}.{}.idx".format(name, fmt))
+
+    def devices(self):
+        """Returns: names of the devices with archived outputs."""
+
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            d
+            for d in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, d))
+            and not d.startswith(".")
+            and d != BLOBS_DIR
+        )
+
+    def _load_state(self, device):
+        try:
+            with open(
+                os.path.join(self._index_dir(device), STATE_FILE), encoding="utf-8"
+            ) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return {"manifest": None, "files": {}}
+
+    def _save_state(self, device, state):
+        path = os.path.join(self._index_dir(device), STATE_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as fp:
+            json.dump(state, fp)
+        os.replace(path + ".tmp", path)
+
+    def _last_ts(self, path):
+        """Returns: ts of the last record of an index file, None if empty."""
+
+        try:
+            with open(path, "rb") as fp:
+                count = os.fstat(fp.fileno()).st_size // RECORD.size
+                if not count:
+                    return None
+                fp.seek((count - 1) * RECORD.size)
+                return RECORD.unpack(fp.read(RECORD.size))[0]
+        except FileNotFoundError:
+            return None
+
+    def _append(self, path, records):
+        """
+        Appends records to an index file; merges them in if some are older
+        than its last record.
+        """
+
+        records.sort()
+        last_ts = self._last_ts(path)
+        if last_ts is not None and records[0][0] < last_ts:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            count = len(data) // RECORD.size
+            records = sorted(
+                [RECORD.unpack_from(data, i * RECORD.size) for i in range(count)]
+                + records
+            )
+            mode = "wb"
+        else:
+            mode = "ab"
+        with open(path + ".tmp" if mode == "wb" else path, mode) as fp:
+            fp.write(b"".join(RECORD.pack(*r) for r in records))
+        if mode == "wb":
+            os.replace(path + ".tmp", path)
+
+    def _drop_manifest_records(self, path):
+        """Drops the records of the archive store from an index file."""
+
+        with open(path + ".tmp", "wb") as fp:
+            for record in self._records(path):
+                if record[1] < 0:
+                    fp.write(RECORD.pack(*record))
+        os.replace(path + ".tmp", path)
+
+    def _update_manifest(self, device, state):
+        """Indexes the lines appended to the manifest of a device."""
+
+        path = os.path.join(self.root, device, MANIFEST_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 0
+        inode, offset = state["manifest"] or (None, 0)
+        if inode != stat.st_ino or offset > stat.st_size:
+            # Compacted (rewritten) manifest: index it again. The records of
+            # the files store, some of bundled files, are kept
+            for name in os.listdir(self._index_dir(device)):
+                if name.endswith(".idx"):
+                    self._drop_manifest_records(
+                        os.path.join(self._index_dir(device), name)
+                    )
+            offset = 0
+
+        records = {}  # (command_dir, format) -> [(ts, offset)]
+        with open(path, "rb") as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    break  # Partial line of a write in progress
+                fields = line.decode("utf-8").rstrip("\n").split("\t")
+                if len(fields) == 4 and fields[0].isdigit():
+                    records.setdefault((command_dir(fields[1]), fields[2]), []).append(
+                        (int(fields[0]), offset)
+                    )
+                offset += len(line)
+        for (name, fmt), r in records.items():
+            self._append(self._index_path(device, name, fmt), r)
+        state["manifest"] = [stat.st_ino, offset]
+        return sum(len(r) for r in records.values())
+
+    def _update_files(self, device, state):
+        """Indexes the output files of a device not indexed yet."""
+
+        device_dir = os.path.join(self.root, device)
+        indexed = 0
+        for name in os.listdir(device_dir):
+            if name.startswith(".") or not os.path.isdir(
+                os.path.join(device_dir, name)
+            ):
+                continue
+            timestamps = {}  # format -> [ts]
+            for f in os.listdir(os.path.join(device_dir, name)):
+                ts, _, fmt = f.partition(".")
+                if ts.isdigit() and fmt in ("cli", "json"):
+                    timestamps.setdefault(fmt, []).append(int(ts))
+
+            for fmt, tss in timestamps.items():
+                key = "{}.{}".format(name, fmt)
+                last_ts, count = state["files"].get(key, (-1, 0))
+                new = [ts for ts in tss if ts > last_ts]
+                path = self._index_path(device, name, fmt)
+                if len(tss) - len(new) > count:
+                    # Files added in the past, e.g. by reparse.py: index the
+                    # missing ones. Files bundled or removed by the retention
+                    # stay indexed, see drop_before.
+                    known = {ts for ts, _ in self._records(path)}
+                    new = [ts for ts in tss if ts not in known]
+                if new:
+                    self._append(path, [(ts, -1) for ts in new])
+                    indexed += len(new)
+                state["files"][key] = [max(tss), len(tss)]
+        return indexed
+
+    def _records(self, path):
+        """Returns: generator of the (ts, offset) records of an index file."""
+
+        try:
+            fp = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with fp:
+            while True:
+                data = fp.read(READ_RECORDS * RECORD.size)
+                data = data[: len(data) // RECORD.size * RECORD.size]
+                if not data:
+                    return
+                yield from RECORD.iter_unpack(data)
+
+    def drop_before(self, device, name, ts):
+        """
+        Drops the records of the output files of a command directory older
+        than ts, e.g. removed by the retention.
+        """
+
+        with self._lock(device):
+            for fmt in ("cli", "json"):
+                path = self._index_path(device, name, fmt)
+                if not os.path.exists(path):
+                    continue
+                with open(path + ".tmp", "wb") as fp:
+                    for record in self._records(path):
+                        if record[0] >= ts or record[1] >= 0:
+                            fp.write(RECORD.pack(*record))
+                os.replace(path + ".tmp", path)
+
+    @contextlib.contextmanager
+    def _lock(self, device):
+        """Serialises the updates of the index of a device across processes."""
+
+        os.makedirs(self._index_dir(device), exist_ok=True)
+        with open(os.path.join(self._index_dir(device), ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def update(self, devices=None):
+        """
+        Indexes the outputs archived since the last update.
+
+        Returns: number of records indexed.
+        """
+
+        indexed = 0
+        for device in devices or self.devices():
+            if not os.path.isdir(os.path.join(self.root, device)):
+                continue
+            with self._lock(device):
+                state = self._load_state(device)
+                indexed += self._update_manifest(device, state)
+                indexed += self._update_files(device, state)
+                self._save_state(device, state)
+        log.info("Indexed %i outputs", indexed)
+        return indexed
+
+    def _bisect(self, fp, count, ts):
+        """Returns: position of the first record not older than ts."""
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            fp.seek(middle * RECORD.size)
+            if RECORD.unpack(fp.read(RECORD.size))[0] < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _read(self, device, name, fmt, ts, offset, manifest, bundles):
+        """
+        Reads an output file, or else its bundle (see utils/retention.py),
+        kept in bundles for the next outputs of the day.
+
+        Returns: content of an output, None if removed since indexed.
+        """
+
+        if offset < 0:
+            directory = os.path.join(self.root, device, name)
+            file = "{}.{}".format(ts, fmt)
+            try:
+                with open(os.path.join(directory, file), encoding="utf-8") as fp:
+                    return fp.read()
+            except FileNotFoundError:
+                pass
+            day = retention.day_of(ts)
+            if day not in bundles:
+                bundles.clear()
+                bundles[day] = retention.read_bundle(directory, day)
+            content = bundles[day].get(file)
+            return content.decode("utf-8") if content is not None else None
+        manifest.seek(offset)
+        digest = manifest.readline().decode("utf-8").rstrip("\n").split("\t")[-1]
+        try:
+            return self.archive.get(digest)
+        except FileNotFoundError:
+            return None
+
+    def query(self, device, command, start=0, end=None, fmt="json"):
+        """
+        Reads the outputs of a command of a device over a time range
+        (ms, inclusive), in time order; see update for the recent outputs.
+
+        Returns: generator of (ts, content), JSON outputs parsed.
+        """
+
+        name = command_dir(command)
+        try:
+            fp = open(self._index_path(device, name, fmt), "rb")
+        except FileNotFoundError:
+            return
+        try:
+            manifest = open(os.path.join(self.root, device, MANIFEST_FILE), "rb")
+        except FileNotFoundError:
+            manifest = None
+        bundles = {}  # day -> outputs of the bundle of the day
+        try:
+            count = os.fstat(fp.fileno()).st_size // RECORD.size
+            position = self._bisect(fp, count, start)
+            fp.seek(position * RECORD.size)
+            while position < count:
+                n = min(READ_RECORDS, count - position)
+                data = fp.read(n * RECORD.size)
+                position += n
+                for ts, offset in RECORD.iter_unpack(data):
+                    if end is not None and ts > end:
+                        return
+                    content = self._read(
+                        device, name, fmt, ts, offset, manifest, bundles
+                    )
+                    if content is None:
+                        continue
+                    yield (ts, json.loads(content) if fmt == "json" else content)
+        finally:
+            fp.close()
+            if manifest:
+                manifest.close()
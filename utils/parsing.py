@@ -0,0 +1,105 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Supports parsing of raw CLI outputs, away from the device sessions.
+
+The functions are meant to run in a process pool: the switch collectors
+fetch raw CLI text with many I/O threads and hand it over to parser
+processes, so that CPU-heavy genie parsing is not serialized by the GIL.
+"""
+
+import time
+
+from ttp import ttp
+from genie.conf.base import Device
+from genie.libs.parser.utils.common import ParserNotFound, get_parser
+from genie.metaparser.util.exceptions import SchemaEmptyParserError
+
+from .logger import log
+
+# Offline devices used for parsing, one per OS (per process)
+_devices = {}
+
+# Interface used to look up the parsers of per-interface commands
+SAMPLE_INTERFACE = "GigabitEthernet1/0/1"
+
+# TTP templates of commands without genie parser
+TTP_TEMPLATES = {
+    "show energywise": """Total: {{ total_usage }} (W), Count: {{ count }}""",
+}
+
+
+def _device(device_os):
+    if device_os not in _devices:
+        device = Device("parser", os=device_os)
+        device.custom.setdefault("abstraction", {})["order"] = ["os"]
+        _devices[device_os] = device
+    return _devices[device_os]
+
+
+def init_worker(device_oses, commands):
+    """
+    Initializes a parser process: creates the offline devices and loads the
+    genie parsers of the given commands, so that the first parsing is not cold.
+    Commands may contain a "%s" placeholder for an interface.
+    """
+
+    for device_os in device_oses:
+        for command in commands:
+            if "%s" in command:
+                command = command % SAMPLE_INTERFACE
+            try:
+                get_parser(command, _device(device_os))
+            except Exception as e:
+                log.debug("No parser to preload for command {}: {}".format(command, e))
+
+
+def parse_output(job):
+    """
+    Parses the raw output of a command.
+    Expects: job = (device os, command, raw output)
+
+    Returns: parsed output, {} if the output is empty,
+    None if no parser exists for the command.
+    """
+
+    device_os, command, raw = job
+
+    try:
+        return _device(device_os).parse(command, output=raw)
+    except SchemaEmptyParserError as e:
+        log.error("Failed to parse output of command {}: {}".format(command, e))
+        return {}
+    except ParserNotFound:
+        if command in TTP_TEMPLATES:
+            parser = ttp(data=raw, template=TTP_TEMPLATES[command])
+            parser.parse()
+            return float(parser.result()[0][0]["total_usage"])
+        log.warning('No parser found for command : "{}"'.format(command))
+        return None
+
+
+def parse_output_timed(job):
+    """
+    Parses the raw output of a command, see parse_output.
+
+    Returns: (parsed output, parsing duration in seconds).
+    """
+
+    start = time.perf_counter()
+    out = parse_output(job)
+    return out, time.perf_counter() - start
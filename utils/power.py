@@ -0,0 +1,283 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Supports the transformation of switch CLI data into Thingsboard telemetry.
+"""
+
+import re
+import json
+
+from .logger import log
+
+# Interface name: <type><member>/[<module>/]<slot>/<port>,
+# e.g. GigabitEthernet1/0/1, or Gi1/1/0/1 on modular members
+INTERFACE_REGEX = re.compile(r"^\D+(\d+)((?:/\d+){2,3})$")
+
+# Commands of the switch telemetry archived under extra-output, by archive
+# name (streamer_collector, streamer_switches_extra) -> command of the payload
+ARCHIVED_COMMANDS = {
+    "show env all": "show env all",
+    "show environment all": "show env all",
+    "show power inline": "show power inline",
+}
+
+
+def interface_position(intf):
+    """
+    Returns: (member, [module,] slot, port) of an interface name, as integers,
+    None if the name has no member.
+    """
+
+    match = INTERFACE_REGEX.match(intf)
+    if not match:
+        return None
+    member, ports = match.groups()
+    return (int(member),) + tuple(int(n) for n in ports[1:].split("/"))
+
+
+def index_interfaces(interfaces):
+    """
+    Groups interface names by stack member, in one pass.
+
+    Returns: {member: [interface, ...]}, members as strings,
+    interfaces in the order of the output.
+    """
+
+    index, unmatched = {}, []
+    for intf in interfaces:
+        match = INTERFACE_REGEX.match(intf)
+        if match:
+            index.setdefault(match.group(1), []).append(intf)
+        else:
+            unmatched.append(intf)
+    if unmatched:
+        log.warning(
+            "Interfaces without member/slot/port, not attributed to a member: "
+            + ", ".join(unmatched)
+        )
+
+    return index
+
+
+def _env_values(device, member):
+    values = {}
+    if "fan" in member:
+        for fan in member["fan"]:
+            values["fan_{}_state".format(fan)] = member["fan"][fan]["state"]
+    else:
+        log.warning("No FAN information for {}".format(device))
+
+    for temperature in (
+        "hotspot_temperature",
+        "inlet_temperature",
+        "outlet_temperature",
+    ):
+        if temperature in member:
+            values[temperature] = float(member[temperature]["value"])
+        else:
+            log.warning("No {} information for {}".format(temperature, device))
+
+    return values
+
+
+def _power_inline_values(power_inline, interfaces_index, switch):
+    values = {}
+    pw_inline_watts = power_inline["watts"]
+    try:
+        watts = pw_inline_watts[str(switch)]
+    except KeyError:
+        watts = pw_inline_watts[switch]
+    values["watts_available"] = int(watts["available"])
+    values["watts_remaining"] = int(watts["remaining"])
+    values["used"] = int(watts["used"])
+
+    pw_inline_interfaces = power_inline["interface"]
+    total_power = 0
+    for intf in interfaces_index.get(str(switch), []):
+        interface = pw_inline_interfaces[intf]
+        values["{}_oper_state".format(intf)] = interface["oper_state"]
+        values["{}_power".format(intf)] = int(interface["power"])
+        values["{}_device".format(intf)] = interface.get("device", None)
+        total_power += int(interface["power"])
+    values["total_interfaces_power"] = total_power
+
+    return values
+
+
+def switch_telemetry(payload):
+    """
+    Transforms the parsed CLI outputs of a switch (stack) into telemetry,
+    one Thingsboard device per stack member: <device>_<member>.
+
+    The payload may hold only a subset of the commands ("show env all",
+    "show power inline"); only the values of those commands are returned.
+
+    Returns: {"<device>_<member>": [{"ts": ts, "values": {...}}]}.
+    """
+
+    json_body = {}
+    switchstack = payload.get("show env all", {}).get("switch", {})
+    members = list(switchstack)
+    interfaces_index = {}
+    if "show power inline" in payload and payload["show power inline"]:
+        interfaces_index = index_interfaces(
+            payload["show power inline"].get("interface", {})
+        )
+        members += [
+            m for m in payload["show power inline"].get("watts", {}) if m not in members
+        ]
+
+    for switch in members:
+        log.info("Device {} - switch {}.".format(payload["device"], switch))
+        device = "{}_{}".format(payload["device"], switch)
+        values = {}
+
+        # show env all
+        if switch in switchstack:
+            values.update(_env_values(device, switchstack[switch]))
+
+        # show power inline
+        if "show power inline" in payload:
+            if payload["show power inline"]:
+                values.update(
+                    _power_inline_values(
+                        payload["show power inline"], interfaces_index, switch
+                    )
+                )
+            else:
+                values["total_interfaces_power"] = 0
+
+        if values:
+            json_body[device] = [{"ts": payload["date"], "values": values}]
+
+    return json_body
+
+
+# Telemetry schemas of the per-port values:
+# - flat: <intf>_oper_state, <intf>_power, <intf>_device keys on the member
+# - ports: one child device per port, <member device>_<intf>, numeric values
+# - compact: ports_power and ports_state JSON arrays on the member,
+#   in the order of the "ports" attribute
+SCHEMAS = ("flat", "ports", "compact")
+PORT_SUFFIXES = ("_oper_state", "_power", "_device")
+OPER_STATES = {"on": 1, "off": 0}
+
+
+def _split_port_values(values):
+    """
+    Separates the per-port values from the other values of a member.
+
+    Returns: (other values, {intf: {"oper_state", "power", "device"}}).
+    """
+
+    others, ports = {}, {}
+    for key, value in values.items():
+        for suffix in PORT_SUFFIXES:
+            intf = key[: -len(suffix)]
+            if key.endswith(suffix) and INTERFACE_REGEX.match(intf):
+                ports.setdefault(intf, {})[suffix[1:]] = value
+                break
+        else:
+            others[key] = value
+    return others, ports
+
+
+def encode_schema(collections, schema):
+    """
+    Re-encodes flat switch telemetry, as returned by switch_telemetry,
+    into the given schema. Static strings (the powered device of each port)
+    become attributes. Samples without per-port values are left unchanged.
+
+    Returns: (collections, attributes), attributes as {device: {key: value}}.
+    """
+
+    if schema == "flat":
+        return collections, {}
+
+    encoded, attributes = [], {}
+    for collection in collections:
+        body = {}
+        for device, samples in collection.items():
+            for sample in samples:
+                others, ports = _split_port_values(sample["values"])
+                if not ports:
+                    # e.g. the APs' telemetry, published with the switches'
+                    body.setdefault(device, []).append(sample)
+                    continue
+                order = sorted(ports, key=interface_position)
+                if schema == "ports":
+                    for intf in order:
+                        port_device = "{}_{}".format(device, intf)
+                        body.setdefault(port_device, []).append(
+                            {
+                                "ts": sample["ts"],
+                                "values": {
+                                    "power": ports[intf]["power"],
+                                    "oper_state": OPER_STATES.get(
+                                        ports[intf]["oper_state"], -1
+                                    ),
+                                },
+                            }
+                        )
+                        attributes[port_device] = {"device": ports[intf]["device"]}
+                else:
+                    others["ports_power"] = [ports[i]["power"] for i in order]
+                    others["ports_state"] = [
+                        OPER_STATES.get(ports[i]["oper_state"], -1) for i in order
+                    ]
+                    attributes[device] = {"ports": order}
+                    attributes[device].update(
+                        {i + "_device": ports[i]["device"] for i in order}
+                    )
+                body.setdefault(device, []).append(
+                    {"ts": sample["ts"], "values": others}
+                )
+        encoded.append(body)
+
+    return encoded, attributes
+
+
+def payload_size(collections):
+    """Returns: size in bytes of the MQTT payloads of the collections."""
+
+    return sum(len(json.dumps(c)) for c in collections)
+
+
+def ap_telemetry(payload, neighbors):
+    """
+    Transforms the PoE details of a switch into telemetry of the
+    connected APs.
+    Expects: neighbors = [(AP name, local interface)], see cdp.get_cdp_neighbors
+
+    Returns: {"<AP>": [{"ts": ts, "values": {"PoE": 6.5}}]}.
+    """
+
+    json_body = {}
+    for ap_name, interface in neighbors:
+        detail = payload.get("show power inline {} detail".format(interface))
+        try:
+            measured_power = float(
+                detail["interface"][interface]["measured_consumption"]
+            )
+        except (KeyError, TypeError):
+            log.debug("No PoE detail for AP {} on {}".format(ap_name, interface))
+            continue
+        json_body[ap_name] = [
+            {"ts": payload["date"], "values": {"PoE": measured_power}}
+        ]
+
+    return json_body
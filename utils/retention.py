@@ -0,0 +1,257 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Retention of the output directories of the streamers, by category (e.g.
+CDP snapshots, extra-output), with policies loaded once from the YAML file
+in env variable RETENTION_FILE (default /onboard/retention.yml), or else
+the built-in policies below. Each policy holds, all optional:
+  max_age_days       outputs older are removed
+  max_mb             over this size, the oldest days of the category are
+                     removed
+  keep_latest        newest outputs of each directory never removed nor
+                     bundled, e.g. the CDP neighbors read by streamer_aps;
+                     the files of a timestamp (.cli, .json) are one output
+  bundle_after_days  outputs of the days older are rolled into one
+                     compressed bundle per day and directory
+
+Outputs are the files named after their timestamp (ms), with an optional
+format extension (e.g. 1681912800000.json), or after their day
+(timings-2023-04-19.jsonl). Bundles are named after their UTC day:
+  <directory>/2023-04-19.tar.gz     files of the day, under their name
+"""
+
+import io
+import os
+import re
+import time
+import tarfile
+import calendar
+
+import yaml
+
+from .logger import log
+
+RETENTION_FILE = os.getenv("RETENTION_FILE", "/onboard/retention.yml")
+DAY_MS = 24 * 3600 * 1000
+BUNDLE_SUFFIX = ".tar.gz"
+DEFAULT_POLICIES = {
+    "cdp": {"max_age_days": 30, "keep_latest": 24, "bundle_after_days": 1},
+    "extra": {"max_age_days": 90, "keep_latest": 1, "bundle_after_days": 1},
+    "timings": {"max_age_days": 30},
+}
+
+_TS_NAME = re.compile(r"(\d{10,13})(?:\.\w+)?$")
+_DAY_NAME = re.compile(r"timings-(\d{4}-\d{2}-\d{2})\.jsonl$")
+_BUNDLE_NAME = re.compile(r"(\d{4}-\d{2}-\d{2})\.tar\.gz$")
+
+
+def day_of(ts):
+    """Returns: UTC day of a timestamp (ms), e.g. 2023-04-19."""
+
+    return time.strftime("%Y-%m-%d", time.gmtime(ts / 1000))
+
+
+def day_start(day):
+    """Returns: timestamp (ms) of the start of a UTC day."""
+
+    return calendar.timegm(time.strptime(day, "%Y-%m-%d")) * 1000
+
+
+def file_ts(name):
+    """Returns: timestamp (ms) of an output file name, None otherwise."""
+
+    m = _TS_NAME.match(name)
+    if m:
+        return int(m.group(1))
+    m = _DAY_NAME.match(name)
+    if m:
+        return day_start(m.group(1))
+    return None
+
+
+def scan(directory):
+    """Returns: ([(ts, name)] of the outputs, oldest first, {day: bundle name})."""
+
+    outputs, bundles = [], {}
+    for name in os.listdir(directory):
+        m = _BUNDLE_NAME.match(name)
+        if m:
+            bundles[m.group(1)] = name
+            continue
+        ts = file_ts(name)
+        if ts is not None:
+            outputs.append((ts, name))
+    return sorted(outputs), bundles
+
+
+def oldest(directory):
+    """Returns: timestamp (ms) of the oldest output of a directory, bundled or not."""
+
+    outputs, bundles = scan(directory)
+    candidates = [day_start(day) for day in bundles] + [ts for ts, _ in outputs[:1]]
+    return min(candidates) if candidates else None
+
+
+def read_bundle(directory, day):
+    """Returns: {name: content (bytes)} of the bundle of a day, {} if none."""
+
+    try:
+        with tarfile.open(os.path.join(directory, day + BUNDLE_SUFFIX), "r:gz") as tar:
+            return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+    except FileNotFoundError:
+        return {}
+
+
+def bundle(directory, day, names):
+    """
+    Rolls output files into the bundle of their day, written atomically,
+    then removes them.
+    """
+
+    members = read_bundle(directory, day)
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as fp:
+            members[name] = fp.read()
+
+    path = os.path.join(directory, day + BUNDLE_SUFFIX)
+    with tarfile.open(path + ".tmp", "w:gz") as tar:
+        for name, content in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = (file_ts(name) or 0) // 1000
+            tar.addfile(info, io.BytesIO(content))
+    os.replace(path + ".tmp", path)
+
+    for name in names:
+        os.remove(os.path.join(directory, name))
+
+
+def usage(directories):
+    """Returns: (bytes, files) of the directories."""
+
+    size, files = 0, 0
+    for directory in directories:
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                size += entry.stat().st_size
+                files += 1
+    return size, files
+
+
+class RetentionPolicy:
+    """A class that applies the retention of a category of output directories."""
+
+    def __init__(
+        self, max_age_days=None, max_mb=None, keep_latest=0, bundle_after_days=None
+    ):
+        self.max_age_days = max_age_days
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb is not None else None
+        self.keep_latest = keep_latest
+        self.bundle_after_days = bundle_after_days
+
+    @classmethod
+    def load(cls, path=RETENTION_FILE):
+        """Returns: {category: policy} of the policies file, or the default ones."""
+
+        policies = DEFAULT_POLICIES
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                policies = yaml.load(fp, Loader=yaml.Loader)["policies"]
+            log.info("Loaded %i retention policies from %s", len(policies), path)
+        return {category: cls(**p) for category, p in policies.items()}
+
+    def _removable(self, outputs):
+        """
+        Returns: outputs that keep_latest does not protect; the files of a
+        timestamp (e.g. <ts>.cli and <ts>.json) are one output.
+        """
+
+        if not self.keep_latest:
+            return outputs
+        latest = sorted({ts for ts, _ in outputs})[-self.keep_latest :]
+        return [(ts, name) for ts, name in outputs if latest and ts < latest[0]]
+
+    def _apply_directory(self, directory, now_ms):
+        outputs, bundles = scan(directory)
+        outputs = self._removable(outputs)
+
+        if self.max_age_days is not None:
+            cutoff = now_ms - self.max_age_days * DAY_MS
+            for ts, name in outputs:
+                if ts < cutoff:
+                    os.remove(os.path.join(directory, name))
+            outputs = [(ts, name) for ts, name in outputs if ts >= cutoff]
+            for day, name in bundles.items():
+                if day_start(day) + DAY_MS <= cutoff:
+                    os.remove(os.path.join(directory, name))
+
+        if self.bundle_after_days is not None:
+            horizon = day_start(day_of(now_ms)) - self.bundle_after_days * DAY_MS
+            days = {}
+            for ts, name in outputs:
+                if ts < horizon:
+                    days.setdefault(day_of(ts), []).append(name)
+            for day, names in days.items():
+                bundle(directory, day, names)
+
+    def _apply_budget(self, directories):
+        """Removes the oldest days of the directories while over max_bytes."""
+
+        size = usage(directories)[0]
+        days = {}  # day -> [(path, bytes)]
+        for directory in directories:
+            outputs, bundles = scan(directory)
+            for ts, name in self._removable(outputs):
+                days.setdefault(day_of(ts), []).append(os.path.join(directory, name))
+            for day, name in bundles.items():
+                days.setdefault(day, []).append(os.path.join(directory, name))
+
+        removed = []
+        for day in sorted(days):
+            if size <= self.max_bytes:
+                break
+            for path in days[day]:
+                size -= os.path.getsize(path)
+                os.remove(path)
+            removed.append(day)
+        if removed:
+            log.info(
+                "Removed the outputs of %i days up to %s, over %i bytes",
+                len(removed),
+                removed[-1],
+                self.max_bytes,
+            )
+
+    def apply(self, directories, now_ms):
+        """
+        Applies the policy to the directories of a category.
+
+        Returns: {"bytes", "files"} before and {"reclaimed", "remaining"} after.
+        """
+
+        size, files = usage(directories)
+        for directory in directories:
+            self._apply_directory(directory, now_ms)
+        if self.max_bytes is not None:
+            self._apply_budget(directories)
+        after_size, after_files = usage(directories)
+        return {
+            "bytes": size,
+            "files": files,
+            "reclaimed": size - after_size,
+            "remaining": after_files,
+        }
@@ -0,0 +1,206 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Append-only store of the PoE detail samples of a switch.
+
+Layout, under the device directory:
+  segments/<first ts>.jsonl   records, one JSON line each:
+                              {"interface": ..., "ts": ..., "data": ...}
+  segments/<first ts>.idx     index of the segment, one line per record:
+                              <interface> <ts> <offset>
+  segments/latest.json        latest record per interface:
+                              {interface: [ts, segment, offset]}
+
+Records of a cycle are written in one batch. A new segment is started once
+the current one exceeds max_segment_bytes; only the newest max_segments
+segments are retained.
+"""
+
+import os
+import json
+
+from .logger import log
+
+SEGMENTS_DIR = "segments"
+LATEST_FILE = "latest.json"
+
+
+class SegmentStore:
+    """A class that represents the segment store of a device."""
+
+    def __init__(self, device_dir, max_segment_bytes=16 * 1024 * 1024, max_segments=64):
+        self.directory = os.path.join(device_dir, SEGMENTS_DIR)
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+
+    @staticmethod
+    def exists(device_dir):
+        return os.path.exists(os.path.join(device_dir, SEGMENTS_DIR, LATEST_FILE))
+
+    def segments(self):
+        """Returns: names of the segments, oldest first."""
+
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            (
+                f[: -len(".jsonl")]
+                for f in os.listdir(self.directory)
+                if f.endswith(".jsonl")
+            ),
+            key=int,
+        )
+
+    def _path(self, segment, extension):
+        return os.path.join(self.directory, segment + extension)
+
+    def latest_pointers(self):
+        """Returns: {interface: [ts, segment, offset]} of the latest records."""
+
+        try:
+            with open(
+                os.path.join(self.directory, LATEST_FILE), encoding="utf-8"
+            ) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def _save_latest(self, latest):
+        # Write atomically: readers never see a partial index
+        path = os.path.join(self.directory, LATEST_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as fp:
+            json.dump(latest, fp)
+        os.replace(path + ".tmp", path)
+
+    def append(self, records):
+        """
+        Appends a batch of records to the current segment.
+        Expects: records = [(interface, ts, data)]
+        """
+
+        if not records:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+        segments = self.segments()
+        if (
+            not segments
+            or os.path.getsize(self._path(segments[-1], ".jsonl"))
+            >= self.max_segment_bytes
+        ):
+            segments.append(str(records[0][1]))
+        segment = segments[-1]
+
+        lines, index_lines = [], []
+        with open(self._path(segment, ".jsonl"), "ab") as fp:
+            offset = fp.tell()
+            latest = self.latest_pointers()
+            for interface, ts, data in records:
+                line = (
+                    json.dumps({"interface": interface, "ts": int(ts), "data": data})
+                    + "\n"
+                ).encode("utf-8")
+                lines.append(line)
+                index_lines.append("{} {} {}\n".format(interface, int(ts), offset))
+                latest[interface] = [int(ts), segment, offset]
+                offset += len(line)
+            fp.write(b"".join(lines))
+        with open(self._path(segment, ".idx"), "a", encoding="utf-8") as fp:
+            fp.write("".join(index_lines))
+        self._save_latest(latest)
+
+        # Retention
+        for old in segments[: -self.max_segments]:
+            log.info("Removing segment %s of %s", old, self.directory)
+            for extension in (".jsonl", ".idx"):
+                try:
+                    os.remove(self._path(old, extension))
+                except FileNotFoundError:
+                    pass
+
+    def _read(self, segment, offset):
+        with open(self._path(segment, ".jsonl"), "rb") as fp:
+            fp.seek(offset)
+            return json.loads(fp.readline())
+
+    def latest(self, interface, pointers=None):
+        """
+        Reads the latest record of an interface.
+        Expects: pointers, as returned by latest_pointers (optional).
+
+        Returns: (ts, data), or None if no record is retained.
+        """
+
+        pointer = (pointers or self.latest_pointers()).get(interface)
+        if not pointer:
+            return None
+        try:
+            record = self._read(pointer[1], pointer[2])
+        except FileNotFoundError:
+            return None
+        return (record["ts"], record["data"])
+
+    def lookup(self, interface, ts):
+        """
+        Reads the record of an interface at a given timestamp.
+
+        Returns: data, or None if no such record is retained.
+        """
+
+        # Records are appended in time order: only the last segment
+        # starting at or before ts may hold the record
+        candidates = [s for s in self.segments() if int(s) <= int(ts)]
+        if not candidates:
+            return None
+        with open(self._path(candidates[-1], ".idx"), encoding="utf-8") as fp:
+            for line in fp:
+                name, record_ts, offset = line.rsplit(" ", 2)
+                if name == interface and int(record_ts) == int(ts):
+                    return self._read(candidates[-1], int(offset))["data"]
+        return None
+
+    def history(self, interface=None, start=None, end=None):
+        """
+        Iterates over the retained records, oldest first.
+        Expects: start, end = time range in ms, inclusive (optional).
+
+        Returns: generator of (interface, ts, data).
+        """
+
+        segments = self.segments()
+        for i, segment in enumerate(segments):
+            # Records are appended in time order: a segment ends before
+            # the next one starts
+            if start is not None and i + 1 < len(segments):
+                if int(segments[i + 1]) < start:
+                    continue
+            if end is not None and int(segment) > end:
+                break
+            with open(self._path(segment, ".jsonl"), encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partial record of an interrupted write
+                        continue
+                    if interface is not None and record["interface"] != interface:
+                        continue
+                    if start is not None and record["ts"] < start:
+                        continue
+                    if end is not None and record["ts"] > end:
+                        continue
+                    yield (record["interface"], record["ts"], record["data"])
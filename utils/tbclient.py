@@ -49,6 +49,7 @@ class TbRestClient:
             self.proxies["http"] = os.environ["HTTPS_PROXY"]
             self.proxies["https"] = os.environ["HTTPS_PROXY"]
 
+        self._entity_ids = {}  # (entity type, name) -> ID, IDs never change
         self._client_token = self._tb_get_client_token()
         self._headers = {
             "accept": "application/json",
@@ -136,6 +137,9 @@ class TbRestClient:
         return -1
 
     def tb_get_entity_id(self, entity):
+        if (entity.entity_type, entity.name) in self._entity_ids:
+            return self._entity_ids[(entity.entity_type, entity.name)]
+
         r = None
         try:
             r = requests.get(
@@ -151,10 +155,10 @@ class TbRestClient:
                 timeout=10,
             )
             if r.status_code == 200:
-                log.debug(
-                    "Entity ID for entity %s is %s", entity.name, r.json()["id"]["id"]
-                )
-                return r.json()["id"]["id"]
+                entity_id = r.json()["id"]["id"]
+                log.debug("Entity ID for entity %s is %s", entity.name, entity_id)
+                self._entity_ids[(entity.entity_type, entity.name)] = entity_id
+                return entity_id
             elif gettrace():  # Dump stack trace if program is run in debug mode
                 r.raise_for_status()
         except requests.HTTPError as err:
@@ -421,8 +425,20 @@ class TbRestClient:
 
             log.error("Failed to assign to customer: %s", r.json())
 
-    def tb_read_historical_values(self, device, start_ts, end_ts, request_filters=""):
+    def tb_read_historical_values(
+        self, device, start_ts, end_ts, request_filters="", raise_errors=False
+    ):
+        """
+        Returns: {key: [{"ts": ts, "value": value}]}, -1 if the request failed;
+        with raise_errors, raises LookupError if the device is not defined,
+        requests.HTTPError if the request failed.
+        """
+
         device_id = self.tb_get_entity_id(device)
+        if device_id == -1:
+            if raise_errors:
+                raise LookupError("no entity ID for " + device.name)
+            return -1
 
         r = None
         try:
@@ -437,6 +453,7 @@ class TbRestClient:
                 + request_filters,
                 headers=self._headers,
                 proxies=self.proxies,
+                timeout=60,
             )
             if r.status_code == 200:
                 log.debug(
@@ -446,9 +463,11 @@ class TbRestClient:
                     end_ts,
                 )
                 return r.json()
-            if gettrace():  # Dump stack trace if program is run in debug mode
+            if raise_errors or gettrace():  # Stack trace in debug mode
                 r.raise_for_status()
         except requests.HTTPError as err:
+            if raise_errors:
+                raise
             log.debug(
                 "Failed to get historical values for %s: startTs: %s, endTs: %s - %s, %s",
                 device_id,
@@ -460,3 +479,44 @@ class TbRestClient:
 
         log.error("Failed to get historical values for %s", r.json())
         return -1
+
+    def tb_save_timeseries(self, device, samples):
+        """
+        Saves timeseries of a device over Thingsboard's REST API.
+        Expects: samples = [{"ts": ts, "values": {key: value}}]
+
+        Returns: True if saved.
+        """
+
+        device_id = self.tb_get_entity_id(device)
+
+        r = None
+        try:
+            r = requests.post(
+                url=self.api["url"]
+                + "/plugins/telemetry/DEVICE/"
+                + device_id
+                + "/timeseries/ANY",
+                headers=self._headers,
+                json=samples,
+                proxies=self.proxies,
+                timeout=30,
+            )
+            if r.status_code == 200:
+                log.debug(
+                    "Saved %i samples for %s - %s", len(samples), device.name, device_id
+                )
+                return True
+            if gettrace():  # Dump stack trace if program is run in debug mode
+                r.raise_for_status()
+        except requests.HTTPError as err:
+            log.debug(
+                "Failed to save samples for %s - %s: %s - %s",
+                device.name,
+                device_id,
+                err,
+                r,
+            )
+
+        log.error("Failed to save samples for %s - %s: %s", device.name, device_id, r)
+        return False
@@ -0,0 +1,101 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Supports per-device, per-phase timing of the collection cycles.
+
+Phases: connect, execute, parse, write, publish.
+
+Records are appended as JSON lines to a daily file, e.g.:
+{"ts": 1681912800000, "device": "switch_1", "phase": "parse",
+ "command": "show power inline", "duration_ms": 812.5}
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+from .logger import log
+
+
+class Timings:
+    """A class that collects the timings of a collection cycle."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, device, phase, duration_s, command=None):
+        record = {
+            "ts": int(time.time_ns() / 1000000),
+            "device": str(device),
+            "phase": phase,
+            "command": command,
+            "duration_ms": round(duration_s * 1000, 1),
+        }
+        with self._lock:
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def phase(self, device, phase, command=None):
+        """Times the enclosed block as a phase of the device."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(device, phase, time.perf_counter() - start, command)
+
+    def write(self, directory):
+        """Appends the records to the daily file in directory and resets them."""
+
+        with self._lock:
+            records, self.records = self.records, []
+        if not records:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        file = os.path.join(
+            directory, "timings-" + time.strftime("%Y-%m-%d") + ".jsonl"
+        )
+        with open(file, "a", encoding="utf-8") as output_file:
+            for record in records:
+                output_file.write(json.dumps(record) + "\n")
+        log.info("Saved %i timing records to %s", len(records), file)
+
+    def telemetry(self, device="streamer"):
+        """
+        Summarizes the records per phase as telemetry of the streamer device:
+        total and max duration, and the slowest device.
+
+        Returns: Thingsboard-MQTT formatted collection, e.g.:
+        {"streamer": [{"ts": ts, "values": {"parse_ms": 8125.0, ...}}]}
+        """
+
+        values = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            phase = record["phase"]
+            values[phase + "_ms"] = values.get(phase + "_ms", 0) + record["duration_ms"]
+            if record["duration_ms"] > values.get(phase + "_max_ms", -1):
+                values[phase + "_max_ms"] = record["duration_ms"]
+                values[phase + "_slowest_device"] = record["device"]
+        values["devices"] = len({record["device"] for record in records})
+
+        return {device: [{"ts": int(time.time_ns() / 1000000), "values": values}]}
@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Index of the APs' switch ports, maintained from the CDP collections of
+the switch collectors and read by streamer_aps, onboarding and the exporter.
+
+File format (JSON), written atomically:
+{"version": 1, "generation": 12, "updated": 1681912800000,
+ "switches": {switch: {interface: AP}}}
+
+The generation is incremented on every save. Path: env variable
+TOPOLOGY_FILE, /topology/topology.json by default.
+"""
+
+import os
+import json
+import time
+import threading
+
+from .logger import log
+
+TOPOLOGY_FILE = os.getenv("TOPOLOGY_FILE", "/topology/topology.json")
+VERSION = 1
+
+
+class Topology:
+    """A class that indexes the APs by name, by switch and by switch port."""
+
+    def __init__(self, switches=None, generation=0):
+        self.generation = generation
+        self.switches = {}  # switch -> {interface: AP}
+        self.aps = {}  # AP -> (switch, interface)
+        self._lock = threading.Lock()
+        for switch, ports in (switches or {}).items():
+            self.update_switch(switch, [(ap, i) for i, ap in ports.items()])
+
+    @classmethod
+    def load(cls, path=TOPOLOGY_FILE):
+        """Returns: topology of the file, empty if missing or of another version."""
+
+        try:
+            with open(path, encoding="utf-8") as fp:
+                content = json.load(fp)
+        except FileNotFoundError:
+            return cls()
+        if content.get("version") != VERSION:
+            log.error(
+                "Ignoring topology file %s of version %s, expected %s",
+                path,
+                content.get("version"),
+                VERSION,
+            )
+            return cls()
+        return cls(content["switches"], content["generation"])
+
+    def save(self, path=TOPOLOGY_FILE):
+        with self._lock:
+            self.generation += 1
+            content = {
+                "version": VERSION,
+                "generation": self.generation,
+                "updated": int(time.time_ns() / 1000000),
+                "switches": self.switches,
+            }
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump(content, fp)
+            os.replace(path + ".tmp", path)
+        log.info("Saved topology generation %i to %s", self.generation, path)
+
+    def update_switch(self, switch, neighbors):
+        """
+        Replaces the APs of a switch.
+        Expects: neighbors = [(AP, local interface)], see cdp.get_cdp_neighbors
+
+        Returns: True if the APs of the switch changed.
+        """
+
+        ports = {interface: ap for ap, interface in neighbors}
+        with self._lock:
+            if self.switches.get(switch) == ports:
+                return False
+            for ap in self.switches.get(switch, {}).values():
+                if self.aps.get(ap, (None,))[0] == switch:
+                    del self.aps[ap]
+            self.switches[switch] = ports
+            for interface, ap in ports.items():
+                self.aps[ap] = (switch, interface)
+        return True
+
+    def ap(self, name):
+        """Returns: (switch, interface) of an AP, None if unknown."""
+
+        return self.aps.get(name)
+
+    def switch(self, switch):
+        """Returns: [(AP, interface)] of a switch."""
+
+        return [
+            (ap, interface) for interface, ap in self.switches.get(switch, {}).items()
+        ]
+
+    def port(self, switch, interface):
+        """Returns: AP connected to a switch port, None if unknown."""
+
+        return self.switches.get(switch, {}).get(interface)
+
+    def annotate(self, devices):
+        """
+        Sets the switch and interface attributes of the AP devices
+        (TbDevice) known to the index, in place of the ones of aps.yml.
+        """
+
+        for device in devices:
+            port = self.ap(device.name)
+            if port:
+                device.add_attribute("switch", port[0])
+                device.add_attribute("interface", port[1])
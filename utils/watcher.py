@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+"""
+Watches the output directory of the switch collectors with inotify (Linux).
+
+Layout watched:
+  <root>/<switch>/show_power_inline_<interface>_detail/<ts>   (files store)
+  <root>/<switch>/segments/latest.json                        (segments store)
+
+inotify watches are not recursive: a watch is added for every directory
+of the layout, including directories created after start.
+"""
+
+import os
+
+from inotify_simple import INotify, flags
+
+from .logger import log
+from .segments import SEGMENTS_DIR, LATEST_FILE
+
+DETAIL_PREFIX = "show_power_inline_"
+DETAIL_SUFFIX = "_detail"
+
+DIR_MASK = flags.CREATE | flags.MOVED_TO | flags.DELETE_SELF
+FILE_MASK = flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE_SELF
+
+
+def detail_interface(name):
+    """Returns: interface of a PoE details directory name, None otherwise."""
+
+    if name.startswith(DETAIL_PREFIX) and name.endswith(DETAIL_SUFFIX):
+        return name[len(DETAIL_PREFIX) : -len(DETAIL_SUFFIX)]
+    return None
+
+
+class OutputWatcher:
+    """A class that watches the PoE details written by the switch collectors."""
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = INotify()
+        self._watches = {}  # wd -> (kind, switch, interface, path)
+        self._paths = {}  # path -> wd
+
+    def _watch(self, kind, switch, interface, path, mask):
+        if path in self._paths:
+            return []
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except OSError as e:
+            log.warning("Cannot watch %s: %s", path, e)
+            return []
+        self._watches[wd] = (kind, switch, interface, path)
+        self._paths[path] = wd
+
+        # Report the files written before the watch was added
+        if kind == "details":
+            try:
+                names = os.listdir(path)
+            except FileNotFoundError:  # Removed since the event
+                return []
+            return [(switch, interface, os.path.join(path, f)) for f in names]
+        if kind == "segments" and os.path.exists(os.path.join(path, LATEST_FILE)):
+            return [(switch, None, os.path.join(path, LATEST_FILE))]
+        return []
+
+    def _watch_child(self, switch, name):
+        """Watches a new directory of the layout, returns its current files."""
+
+        if switch is None:
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                return []
+            files = self._watch("switch", name, None, path, DIR_MASK)
+            try:
+                children = os.listdir(path)
+            except FileNotFoundError:  # Removed since the event
+                return files
+            for child in children:
+                files += self._watch_child(name, child)
+            return files
+
+        path = os.path.join(self.root, switch, name)
+        if name == SEGMENTS_DIR:
+            return self._watch("segments", switch, None, path, FILE_MASK)
+        interface = detail_interface(name)
+        if interface is not None:
+            return self._watch("details", switch, interface, path, FILE_MASK)
+        return []
+
+    def add_tree(self):
+        """
+        Watches the whole layout; may be called again to pick up
+        directories missed by events.
+
+        Returns: [(switch, interface, path)] of the existing files.
+        """
+
+        files = []
+        if not self._watches:
+            self._watch("root", None, None, self.root, DIR_MASK)
+        for switch in os.listdir(self.root):
+            files += self._watch_child(None, switch)
+        return files
+
+    def read(self, timeout_ms):
+        """
+        Waits for closed files.
+
+        Returns: [(switch, interface, path)]; interface is None for
+        the latest.json file of a segments store.
+        """
+
+        files = []
+        for event in self.inotify.read(timeout=timeout_ms, read_delay=100):
+            if event.wd not in self._watches:
+                continue
+            kind, switch, interface, path = self._watches[event.wd]
+            if event.mask & (flags.IGNORED | flags.DELETE_SELF):
+                # Directory removed: forget it, its watch is gone
+                self._watches.pop(event.wd, None)
+                self._paths.pop(path, None)
+                continue
+            if kind in ("root", "switch"):
+                if event.mask & flags.ISDIR:
+                    files += self._watch_child(switch, event.name)
+            elif kind == "details":
+                files.append((switch, interface, os.path.join(path, event.name)))
+            elif kind == "segments" and event.name == LATEST_FILE:
+                files.append((switch, None, os.path.join(path, event.name)))
+
+        # Deduplicate, keep order
+        return list(dict.fromkeys(files))